@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from threading import Lock
+from models import Pokemon, Pokestop, Gym, GymDetails, Trainer, \
+    GymPokemon, GymMember, Raid, Weather
+from queue import Empty
+from shard import shards, sharded_models, shard_for
+from spool import get_spool
+from utils import get_args, get_queues
+
+log = logging.getLogger(__name__)
+
+args = get_args()
+(db_queue, wh_queue, process_queue, stats_queue) = get_queues()
+
+
+class Batch():
+    # Collects the rows for one model from all the process threads and
+    # hands them to the db queue as one batch, either once there are
+    # enough of them or once the oldest has waited long enough. Rows are
+    # keyed by primary key, so a newer copy replaces the older one. For
+    # GymMember the "row" is a whole roster, keyed by gym, and the one
+    # with the highest sequence wins since the process threads can add
+    # them out of order. Batches for a --db-shard go to its own queue.
+    def __init__(self, model, size, max_age, queue=db_queue):
+        self.model = model
+        self.size = max(size, 1)
+        self.max_age = max_age
+        self.queue = queue
+        self.lock = Lock()
+        self.rows = {}
+        self.started = 0
+
+    def add(self, rows):
+        with self.lock:
+            if not self.rows:
+                self.started = time.time()
+            if self.model is GymMember:
+                for gym_id, roster in rows.iteritems():
+                    if (gym_id not in self.rows or
+                            roster[0] > self.rows[gym_id][0]):
+                        self.rows[gym_id] = roster
+            else:
+                self.rows.update(rows)
+            if len(self.rows) < self.size:
+                return
+            rows = self.take()
+        self.queue.put((self.model, rows))
+
+    def take(self):
+        rows = self.rows
+        self.rows = {}
+        return rows
+
+    def flush(self, force=False):
+        with self.lock:
+            if not self.rows:
+                return
+            if not force and time.time() - self.started < self.max_age:
+                return
+            rows = self.take()
+        log.debug('Flushing %d %s rows.', len(rows), self.model.__name__)
+        self.queue.put((self.model, rows))
+
+
+batches = {model: Batch(model, args.batch_size, args.batch_max_age)
+           for model in (Pokestop, Gym, GymDetails, Trainer, GymPokemon,
+                         GymMember, Raid, Weather)}
+batches[Pokemon] = Batch(Pokemon, args.pokemon_inserts, args.batch_max_age)
+
+shard_batches = {shard: {model: Batch(model, batches[model].size,
+                                      args.batch_max_age, shard.queue)
+                         for model in sharded_models}
+                 for shard in shards}
+
+
+def all_batches():
+    return batches.values() + [batch for models in shard_batches.values()
+                               for batch in models.values()]
+
+
+def queue_rows(model, rows):
+    if not shards or model not in sharded_models:
+        batches[model].add(rows)
+        return
+
+    # Split them by the database their area goes to.
+    split = {}
+    for key, row in rows.iteritems():
+        split.setdefault(shard_for(row), {})[key] = row
+    for shard, shard_rows in split.iteritems():
+        if shard is None:
+            batches[model].add(shard_rows)
+        else:
+            shard_batches[shard][model].add(shard_rows)
+
+
+def batch_flusher():
+    # Makes sure a quiet period doesn't leave rows waiting forever.
+    while True:
+        try:
+            for batch in all_batches():
+                batch.flush()
+        except Exception as e:
+            log.exception('Exception in batch_flusher: %s', repr(e))
+        time.sleep(min(args.batch_max_age, 1.0) / 2)
+
+
+def drain_batches(timeout):
+    # On shutdown: send everything we still hold and give the db threads
+    # a chance to write it out.
+    for batch in all_batches():
+        batch.flush(force=True)
+
+    queues = [(None, db_queue)] + [(shard.name, shard.queue)
+                                   for shard in shards]
+    deadline = time.time() + timeout
+    while (any(queue.unfinished_tasks for name, queue in queues) and
+           time.time() < deadline):
+        time.sleep(0.1)
+
+    for name, queue in queues:
+        if queue.unfinished_tasks:
+            spool_queue(name, queue)
+
+
+def spool_queue(shard, queue):
+    # get_spool is memoized on its arguments, get_spool(None) would be a
+    # second Spool on the main spool's directory.
+    spool = get_spool() if shard is None else get_spool(shard)
+    database = 'the database' if shard is None else 'shard ' + shard
+    if spool is None:
+        log.warning('Shutting down with %d batches still waiting for %s.',
+                    queue.unfinished_tasks, database)
+        return
+
+    # Keep what's still queued for when we're back.
+    count = 0
+    while True:
+        try:
+            model, rows = queue.get_nowait()
+        except Empty:
+            break
+        spool.append([(model.__name__, rows)])
+        queue.task_done()
+        count += 1
+    log.info('Spooled %d batches still waiting for %s.', count, database)
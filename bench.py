@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Micro-benchmarks for the ingest pipeline. Uses the same configuration
+# as whserver.py (config.ini / WHSRV_ environment), but never touches the
+# database, except for an SQLite one with --sqlite.
+import sys
+import time
+import random
+import timeit
+from optparse import OptionParser
+
+from test_webhook import get_pokemon, get_gym, get_gymdetails
+
+
+def get_raid(gym):
+    start = int(time.time()) + random.randint(0, 3600)
+    return {
+        'gym_id': gym['gym_id'],
+        'latitude': gym['latitude'],
+        'longitude': gym['longitude'],
+        'level': random.randint(1, 5),
+        'pokemon_id': random.randint(1, 251),
+        'cp': random.randint(1000, 40000),
+        'move_1': random.randint(1, 137),
+        'move_2': random.randint(200, 281),
+        'spawn': start - 3600,
+        'start': start,
+        'end': start + 2700
+    }
+
+
+class NullDatabase():
+    # Stands in for MySQL: bulk_upsert does all of its own work, the
+    # queries just don't go anywhere.
+    def get_conn(self):
+        return self
+
+    def get_cursor(self):
+        return self
+
+    def escape_string(self, value):
+        return value
+
+    def atomic(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute_sql(self, sql):
+        pass
+
+    def executemany(self, sql, values):
+        pass
+
+
+def upsert_rates(rows, db, repeat):
+    from models import Pokemon, bulk_upsert
+
+    for size in (1, 500):
+        best = 0
+        for i in range(repeat):
+            # Older versions of bulk_upsert modify what they're given.
+            batches = [{n: dict(row) for n, row in
+                        enumerate(rows[first:first + size])}
+                       for first in range(0, len(rows), size)]
+            start = timeit.default_timer()
+            for batch in batches:
+                # Each batch commits on its own, like in db_updater.
+                with db.atomic():
+                    bulk_upsert(Pokemon, batch, db)
+            elapsed = timeit.default_timer() - start
+            best = max(best, len(rows) / elapsed)
+        print "%-12s %10.0f" % ('%i-row' % size, best)
+
+
+def bench_upsert(options):
+    from process import rm_pokemon
+
+    rows = [rm_pokemon(get_pokemon(options)) for i in range(options.records)]
+
+    print "--- Upsert, without the database (rows/sec) ---"
+    upsert_rates(rows, NullDatabase(), options.repeat)
+
+    if options.sqlite:
+        from models import db, create_tables
+        create_tables(db)
+
+        print "--- Upsert, SQLite (rows/sec) ---"
+        upsert_rates(rows, db, options.repeat)
+
+
+def bench_process(options):
+    from process import ProcessHook, db_queue
+    from cache import clear_caches
+
+    PH = ProcessHook()
+    gyms = [get_gym(options) for i in range(options.records)]
+    records = {
+        'pokemon': [get_pokemon(options) for i in range(options.records)],
+        'gym': gyms,
+        'gym_details': [get_gymdetails(dict(gym)) for gym in gyms],
+        'raid': [get_raid(gym) for gym in gyms]
+    }
+
+    print "--- Process stage (records/sec) ---"
+    print "%-12s %10s %10s" % ('', 'cold', 'warm')
+    for whtype in ('pokemon', 'gym', 'gym_details', 'raid'):
+        func = getattr(PH, 'process_' + whtype)
+        best = {'cold': 0, 'warm': 0}
+        for i in range(options.repeat):
+            # The first pass misses the caches, the second one finds
+            # everything in them like a scanner resending the same data.
+            clear_caches()
+            for run in ('cold', 'warm'):
+                start = timeit.default_timer()
+                for message in records[whtype]:
+                    func(message)
+                elapsed = timeit.default_timer() - start
+                best[run] = max(best[run], len(records[whtype]) / elapsed)
+                while not db_queue.empty():
+                    db_queue.get()
+        print "%-12s %10.0f %10.0f" % (whtype, best['cold'], best['warm'])
+
+
+if __name__ == '__main__':
+
+    parser = OptionParser()
+
+    parser.add_option("-n", "--records", type="int",
+                      dest="records", default=20000,
+                      help="Records per webhook type.")
+
+    parser.add_option("-r", "--repeat", type="int",
+                      dest="repeat", default=3,
+                      help="Repetitions, the best one is reported.")
+
+    parser.add_option("-l", "--location", dest="location",
+                      default="40.7128,-74.0060", help="Location")
+
+    parser.add_option("-v", "--variance", dest="variance",
+                      default=.2000, type="float",
+                      help="Location variance")
+
+    parser.add_option("-s", "--sqlite", dest="sqlite", default=None,
+                      help="Also time upserts into this SQLite database.")
+
+    (options, args) = parser.parse_args()
+    # Leave the rest of the command line to whserver's own arguments.
+    sys.argv = sys.argv[:1]
+    if options.sqlite:
+        # Before anything reads the arguments, so the MySQL settings
+        # aren't asked for.
+        sys.argv += ['--db-type', 'sqlite', '--db-file', options.sqlite]
+
+    bench_process(options)
+    bench_upsert(options)
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import time
+
+from cachetools import LRUCache
+from threading import Lock
+
+# Every cache registers here so their counters can be reported together.
+caches = []
+
+
+def fingerprint(row, ignored=()):
+    # Two rows with the same fingerprint would write the same thing.
+    if ignored:
+        return hash(frozenset(item for item in row.iteritems()
+                              if item[0] not in ignored))
+    return hash(frozenset(row.iteritems()))
+
+
+def cache_stats():
+    return {cache.name: cache.stats() for cache in caches}
+
+
+def clear_caches():
+    for cache in caches:
+        cache.clear()
+
+
+class EncounterCache():
+    # Remembers what we last stored for each encounter until the spawn
+    # disappears, so the copies other scanners send us of the same
+    # encounter can be dropped.
+    #
+    # Entries are expired from a heap ordered by disappear time. An entry
+    # that was replaced leaves its old heap item behind, which is skipped
+    # when it comes up.
+
+    # No spawn lasts longer than this, don't trust senders that say so.
+    max_ttl = 3600
+
+    def __init__(self, name, ignored=()):
+        self.name = name
+        self.ignored = ignored
+        self.lock = Lock()
+        self.entries = {}
+        self.expiry = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches.append(self)
+
+    def duplicate(self, key, row, expires):
+        # True if we've already stored exactly this row for key. If not,
+        # remember it until expires (epoch seconds).
+        row_hash = fingerprint(row, self.ignored)
+        now = time.time()
+        expires = min(expires, now + self.max_ttl)
+
+        with self.lock:
+            self.expire(now)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == row_hash:
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            self.entries[key] = (row_hash, expires)
+            if entry is None or entry[1] != expires:
+                heapq.heappush(self.expiry, (expires, key))
+            return False
+
+    def expire(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, key = heapq.heappop(self.expiry)
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == expires:
+                del self.entries[key]
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self.entries)}
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.expiry = []
+
+
+class FingerprintCache():
+    # Remembers a hash of the row we last queued for each gym, pokestop
+    # or weather cell. Scanners resend those on every pass, usually with
+    # nothing new, so a row is only worth writing when its hash changed
+    # or it hasn't been written for refresh seconds (which keeps the
+    # scan times fresh). A size of 0 writes everything.
+    def __init__(self, name, size, refresh, ignored=()):
+        self.name = name
+        self.refresh = refresh
+        self.ignored = ignored
+        self.lock = Lock()
+        self.entries = LRUCache(maxsize=size) if size else None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches.append(self)
+
+    def changed(self, key, row):
+        if self.entries is None:
+            return True
+
+        row_hash = fingerprint(row, self.ignored)
+        now = time.time()
+        # cachetools isn't thread safe.
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None and entry[0] == row_hash and
+                    now - entry[1] < self.refresh):
+                self.hits += 1
+                return False
+
+            self.misses += 1
+            if (entry is None and
+                    len(self.entries) >= self.entries.maxsize):
+                self.evictions += 1
+            self.entries[key] = (row_hash, now)
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self.entries or ())}
+
+    def clear(self):
+        with self.lock:
+            if self.entries is not None:
+                self.entries.clear()
+
+
+class RosterCache():
+    # Remembers the last roster we wrote for each gym: which pokemon
+    # defend it with what cp_decayed, and the trainers' teams and levels.
+    # Most gym details repeat the previous scan, so only what changed is
+    # worth writing. Every refresh seconds a gym is written in full to
+    # make up for anything we missed.
+    def __init__(self, name, size, refresh):
+        self.name = name
+        self.refresh = refresh
+        self.lock = Lock()
+        self.entries = LRUCache(maxsize=size) if size else None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches.append(self)
+
+    def changes(self, gym_id, gym_pokemon, gym_members, trainers):
+        # Takes the rows for a gym's details and returns the ones that
+        # need writing. gym_members is None if the roster is unchanged.
+        if self.entries is None:
+            return gym_pokemon, gym_members, trainers
+
+        defenders = {pokemon_uid: member['cp_decayed']
+                     for pokemon_uid, member in gym_members.iteritems()}
+        levels = {name: (trainer['team'], trainer['level'])
+                  for name, trainer in trainers.iteritems()}
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(gym_id)
+            if entry is None or now - entry[2] >= self.refresh:
+                self.misses += 1
+                if (entry is None and
+                        len(self.entries) >= self.entries.maxsize):
+                    self.evictions += 1
+                self.entries[gym_id] = (defenders, levels, now)
+                return gym_pokemon, gym_members, trainers
+
+            old_defenders, old_levels, written = entry
+            if defenders == old_defenders and levels == old_levels:
+                self.hits += 1
+                return {}, None, {}
+
+            self.misses += 1
+            self.entries[gym_id] = (defenders, levels, written)
+
+        gym_pokemon = {pokemon_uid: row
+                       for pokemon_uid, row in gym_pokemon.iteritems()
+                       if old_defenders.get(pokemon_uid) !=
+                       defenders[pokemon_uid]}
+        trainers = {name: row for name, row in trainers.iteritems()
+                    if old_levels.get(name) != levels[name]}
+        if defenders == old_defenders:
+            gym_members = None
+        return gym_pokemon, gym_members, trainers
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self.entries or ())}
+
+    def clear(self):
+        with self.lock:
+            if self.entries is not None:
+                self.entries.clear()
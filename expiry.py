@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import heapq
+import time
+
+from threading import Event, Lock, Thread
+from models import db, expire_lures, expire_raids, purge_pokemon, \
+    active_expiries
+from shard import shards, targets
+from utils import get_args, get_queues
+
+log = logging.getLogger(__name__)
+
+args = get_args()
+(db_queue, wh_queue, process_queue, stats_queue) = get_queues()
+
+
+class ExpiryScheduler():
+    # Knows when each lure, raid, etc. we've seen runs out, so they can be
+    # cleaned up right then, by key, instead of scanning the tables for
+    # anything that expired.
+    #
+    # Deadlines are kept in a heap. Rescheduling a key leaves its old
+    # heap item behind, which is skipped when it comes up.
+    def __init__(self):
+        self.lock = Lock()
+        self.deadlines = {}
+        self.heap = []
+
+    def schedule(self, kind, key, deadline):
+        with self.lock:
+            if self.deadlines.get((kind, key)) == deadline:
+                return
+            self.deadlines[(kind, key)] = deadline
+            heapq.heappush(self.heap, (deadline, kind, key))
+
+    def due(self, now):
+        # Returns kind -> [keys] of everything that has expired.
+        expired = {}
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, kind, key = heapq.heappop(self.heap)
+                if self.deadlines.get((kind, key)) != deadline:
+                    continue
+                del self.deadlines[(kind, key)]
+                expired.setdefault(kind, []).append(key)
+        return expired
+
+    def pending(self):
+        with self.lock:
+            return len(self.deadlines)
+
+
+expiries = ExpiryScheduler()
+
+
+# Pokestops and spawns are in the --db-shard of their area, if there is
+# one. We don't know which, so every database is asked.
+
+def expire_lures_everywhere(keys):
+    for database, queue in targets():
+        expire_lures(database, keys)
+
+
+class Purger():
+    # Runs the pokemon purge of one database in a thread of its own, so
+    # lures and raids don't wait for a purge that's keeping to
+    # --purge-rate or pausing for a busy database, and neither do the
+    # other databases. Asking while it runs makes it go again once it's
+    # done.
+    def __init__(self, name, database, queue):
+        self.name = name
+        self.database = database
+        self.queue = queue
+        self.requested = Event()
+        self.thread = None
+
+    def request(self):
+        # Only the expiry thread asks, no need to lock.
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name=self.name)
+            self.thread.daemon = True
+            self.thread.start()
+        self.requested.set()
+
+    def run(self):
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            try:
+                purge_pokemon(self.database, self.queue)
+                self.database.release()
+            except Exception as e:
+                log.exception('Exception purging old spawns: %s', repr(e))
+
+
+purgers = [Purger('purge', db, db_queue)] + [
+    Purger('purge-' + shard.name, shard.db, shard.queue) for shard in shards]
+
+
+def request_purge(keys):
+    for purger in purgers:
+        purger.request()
+    if args.ingest_workers and args.worker_id is None:
+        # The spawns go to the workers, so nothing schedules the next
+        # purge for us.
+        expiries.schedule('pokemon', 0, time.time() + 60)
+
+
+# What happens to each kind of record when it expires.
+expire_actions = {
+    'lure': expire_lures_everywhere,
+    'raid': lambda keys: expire_raids(db, keys),
+    # Keyed by the minute the spawns disappeared, the purge takes care
+    # of all of them at once. It's only scheduled in the supervisor.
+    'pokemon': request_purge
+}
+
+
+def load_expiries():
+    # Picks up what was already in the databases when we started.
+    for database, queue in targets():
+        for kind, key, deadline in active_expiries(database):
+            expiries.schedule(kind, key, deadline)
+    log.info('Loaded %d pending expiries from the database.',
+             expiries.pending())
+
+
+def expiry_loop():
+    while True:
+        expired = expiries.due(time.time())
+        for kind, keys in expired.iteritems():
+            try:
+                expire_actions[kind](keys)
+            except Exception as e:
+                log.exception('Exception expiring %s: %s', kind, repr(e))
+                # Try them again in a minute.
+                for key in keys:
+                    expiries.schedule(kind, key, time.time() + 60)
+                continue
+            if args.runtime_statistics:
+                stats_queue.put(('expired', {kind: len(keys)}))
+        if expired:
+            for database, queue in targets():
+                database.release()
+        time.sleep(1)
@@ -0,0 +1,362 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import asyncore
+import asynchat
+import socket
+import time
+import zlib
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from shard import shards
+from utils import get_args, get_queues
+
+log = logging.getLogger(__name__)
+
+args = get_args()
+(db_queue, wh_queue, process_queue, stats_queue) = get_queues()
+
+# Reason phrases for the status line.
+responses = {code: message for code, (message, explain)
+             in BaseHTTPRequestHandler.responses.items()}
+
+
+class BodyError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class BodyDecoder():
+    # Takes the request body as it arrives off the wire and decompresses
+    # it on the fly, refusing to grow past max_size either way.
+    def __init__(self, headers):
+        self.max_size = args.max_body_size * 1024 * 1024
+        self.received = 0
+        self.size = 0
+        self.parts = []
+        self.inflater = None
+
+        self.encoding = headers.get('content-encoding', '').strip().lower()
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding not in ('', 'identity', 'deflate'):
+            raise BodyError(415, 'Unsupported Content-Encoding: ' +
+                            self.encoding)
+
+    def check_size(self, size):
+        if size > self.max_size:
+            raise BodyError(413, 'Body is larger than %i bytes.' %
+                            self.max_size)
+
+    def feed(self, data):
+        self.received += len(data)
+        self.check_size(self.received)
+
+        if self.encoding == 'deflate' and self.inflater is None:
+            # "deflate" is supposed to be zlib wrapped, but plenty of
+            # clients send raw deflate data. Sniff the zlib header.
+            if (len(data) > 1 and ord(data[0]) & 0x0f == 8 and
+                    (ord(data[0]) * 256 + ord(data[1])) % 31 == 0):
+                self.inflater = zlib.decompressobj()
+            else:
+                self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        if self.inflater is not None:
+            try:
+                data = self.inflater.decompress(
+                    data, self.max_size - self.size + 1)
+            except zlib.error as e:
+                raise BodyError(400, 'Unable to decompress body: %s' % e)
+        self.append(data)
+
+    def append(self, data):
+        self.size += len(data)
+        self.check_size(self.size)
+        self.parts.append(data)
+
+    def finish(self):
+        if self.inflater is not None:
+            try:
+                self.append(self.inflater.flush())
+            except zlib.error as e:
+                raise BodyError(400, 'Unable to decompress body: %s' % e)
+        return ''.join(self.parts)
+
+
+def chunk_size(line):
+    try:
+        return int(line.split(';', 1)[0].strip(), 16)
+    except ValueError:
+        raise BodyError(400, 'Bad chunk size.')
+
+
+def read_body(rfile, headers):
+    # Reads a complete request body from a blocking file object. Returns
+    # the decoded body and the number of bytes that came over the wire.
+    decoder = BodyDecoder(headers)
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size = chunk_size(rfile.readline(65537))
+            if size == 0:
+                # Skip any trailers.
+                while rfile.readline(65537) not in ('\r\n', '\n', ''):
+                    pass
+                break
+            decoder.check_size(decoder.received + size)
+            data = rfile.read(size)
+            if len(data) < size:
+                raise BodyError(400, 'Incomplete chunk.')
+            decoder.feed(data)
+            rfile.readline(65537)
+    else:
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BodyError(400, 'Bad Content-Length.')
+        decoder.check_size(length)
+        while length > 0:
+            data = rfile.read(min(length, 65536))
+            if not data:
+                raise BodyError(400, 'Incomplete body.')
+            length -= len(data)
+            decoder.feed(data)
+
+    return decoder.finish(), decoder.received
+
+
+def accept_payload(auth, path, data_string, received):
+    # Decides what happens to a POSTed webhook. Shared by all the HTTP
+    # servers. Returns the HTTP status and any extra headers to send.
+
+    if args.runtime_statistics:
+        stats_queue.put(('bytes', (received, len(data_string))))
+
+    # First check if the path is an accepted value
+    if auth.validate(path) is False:
+        return 404, []
+
+    # If we're falling behind, tell the sender to back off and retry
+    # later instead of piling everything up in memory.
+    if (process_queue.over_watermark() or db_queue.over_watermark() or
+            any(shard.queue.over_watermark() for shard in shards)):
+        process_queue.reject()
+        return args.busy_status, [('Retry-After', str(args.retry_after))]
+
+    # Put it in the process queue
+    process_queue.put(data_string)
+    return 200, []
+
+
+class IngestConnection(asynchat.async_chat):
+    # Close connections that haven't sent anything for this long, so
+    # idle or stalled senders don't pile up.
+    idle_timeout = args.keepalive_timeout or 30
+    # Largest request line + headers we'll buffer.
+    max_header_size = 65536
+
+    def __init__(self, sock, auth, map):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.auth = auth
+        self.last_activity = time.time()
+        self.closing = False
+        self.half_closed = False
+        self.requests_handled = 0
+        self.reset()
+
+    def reset(self):
+        self.buffer = []
+        self.buffered = 0
+        self.headers = None
+        self.decoder = None
+        self.state = 'headers'
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        if self.closing:
+            # Ignore anything else the client sends on this connection.
+            return
+
+        if self.state in ('body', 'chunk-data'):
+            # Decompress as it arrives rather than buffering it all.
+            try:
+                self.decoder.feed(data)
+            except BodyError as e:
+                log.info('Rejected request body: %s', e)
+                self.respond(e.status)
+            return
+
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered > self.max_header_size:
+            self.respond(431 if self.state == 'headers' else 400)
+
+    def found_terminator(self):
+        if self.closing:
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+        try:
+            if self.state == 'headers':
+                self.parse_headers(data)
+            elif self.state == 'body':
+                self.handle_request()
+            elif self.state == 'chunk-size':
+                size = chunk_size(data)
+                if size == 0:
+                    self.state = 'trailers'
+                else:
+                    self.decoder.check_size(self.decoder.received + size)
+                    self.state = 'chunk-data'
+                    self.set_terminator(size)
+            elif self.state == 'chunk-data':
+                self.state = 'chunk-end'
+                self.set_terminator('\r\n')
+            elif self.state == 'chunk-end':
+                self.state = 'chunk-size'
+            elif self.state == 'trailers' and not data:
+                self.handle_request()
+        except BodyError as e:
+            log.info('Rejected request body: %s', e)
+            self.respond(e.status)
+
+    def parse_headers(self, data):
+        lines = data.split('\r\n')
+        # Some clients send a stray CRLF between requests.
+        while lines and not lines[0]:
+            lines.pop(0)
+        try:
+            self.method, self.path, self.version = lines[0].split()
+        except (IndexError, ValueError):
+            self.respond(400)
+            return
+
+        self.headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                self.headers[name.strip().lower()] = value.strip()
+
+        if self.method != 'POST':
+            self.respond(501)
+            return
+
+        self.decoder = BodyDecoder(self.headers)
+
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self.state = 'chunk-size'
+            self.set_terminator('\r\n')
+            return
+
+        try:
+            length = int(self.headers.get('content-length', 0))
+        except ValueError:
+            raise BodyError(400, 'Bad Content-Length.')
+        self.decoder.check_size(length)
+
+        if length > 0:
+            self.state = 'body'
+            self.set_terminator(length)
+        else:
+            self.handle_request()
+
+    def keep_alive(self):
+        if not args.keepalive_timeout:
+            return False
+        if self.requests_handled >= args.keepalive_requests:
+            return False
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def handle_request(self):
+        data_string = self.decoder.finish()
+        status, headers = accept_payload(self.auth, self.path, data_string,
+                                         self.decoder.received)
+        self.requests_handled += 1
+        self.respond(status, headers, self.keep_alive())
+
+    def respond(self, status, headers=[], keep_alive=False):
+        log.debug('"%s %s" %i', getattr(self, 'method', '-'),
+                  getattr(self, 'path', '-'), status)
+        version = 'HTTP/1.1' if args.keepalive_timeout else 'HTTP/1.0'
+        response = ['%s %i %s' % (version, status,
+                                  responses.get(status, '')),
+                    'Content-Length: 0',
+                    'Connection: ' + ('keep-alive' if keep_alive
+                                      else 'close')]
+        response += ['%s: %s' % header for header in headers]
+        self.push('\r\n'.join(response) + '\r\n\r\n')
+
+        if keep_alive:
+            self.reset()
+            return
+
+        self.closing = True
+        self.set_terminator(None)
+        self.linger()
+
+    def linger(self):
+        # Once the response is out, stop sending but keep draining what
+        # the client is still sending until it hangs up. Closing with
+        # unread data would reset the connection and could lose the
+        # response on the way.
+        if self.closing and not self.producer_fifo and not self.half_closed:
+            self.half_closed = True
+            try:
+                self.socket.shutdown(socket.SHUT_WR)
+            except socket.error:
+                self.close()
+
+    def handle_write(self):
+        asynchat.async_chat.handle_write(self)
+        self.linger()
+
+    def handle_error(self):
+        log.debug('Error on ingest connection.', exc_info=True)
+        self.close()
+
+
+class IngestServer(asyncore.dispatcher):
+    # Accepts connections on an already listening socket and hands them
+    # to IngestConnections, all from a single thread.
+    def __init__(self, sock, auth):
+        self.connections = {}
+        asyncore.dispatcher.__init__(self, sock, self.connections)
+        # The socket is already listening, so we didn't go through listen().
+        self.accepting = True
+        self.auth = auth
+        self.last_sweep = time.time()
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is not None:
+            IngestConnection(pair[0], self.auth, self.connections)
+
+    def handle_error(self):
+        log.exception('Error in ingest server.')
+
+    def close_idle(self):
+        now = time.time()
+        if now - self.last_sweep < 1:
+            return
+        self.last_sweep = now
+        for conn in self.connections.values():
+            if (isinstance(conn, IngestConnection) and
+                    now - conn.last_activity > conn.idle_timeout):
+                conn.close()
+
+    def serve_forever(self):
+        while True:
+            asyncore.loop(timeout=1, use_poll=True, map=self.connections,
+                          count=1)
+            self.close_idle()
@@ -1,6 +1,7 @@
 import time
 import random
 import logging
+import json
 import yaml
 import s2sphere
 import traceback
@@ -12,11 +13,26 @@ try:
 except ImportError:
     from yaml import Loader
 
+# Every sender we know of (RM, Monocle, PGScout) posts JSON, so a JSON
+# decoder is tried first. Use a faster one if it happens to be installed.
+try:
+    import ujson as json_engine
+except ImportError:
+    json_engine = json
+
 import timeit
-from peewee import DeleteQuery
-from models import Pokemon, Gym, Pokestop, GymDetails, \
+import itertools
+from models import db, Pokemon, Gym, Pokestop, GymDetails, \
     Trainer, GymPokemon, GymMember, Authorizations, Raid, Weather
-from threading import Thread
+from threading import Thread, Lock
+from queue import Empty
+from projector import Projector, MISSING
+from batch import queue_rows
+from shard import shards
+from spool import get_spool
+from expiry import expiries
+from cache import EncounterCache, FingerprintCache, RosterCache, \
+    cache_stats
 from utils import get_args, get_queues
 
 log = logging.getLogger(__name__)
@@ -48,11 +64,178 @@ cpm = ({1: 0.094, 1.5: 0.135137432, 2: 0.16639787, 2.5: 0.192650919,
         39: 0.78463697, 39.5: 0.787473578, 40: 0.79030001})
 
 
+# Rosters replace each other, so the db writers need to know which of
+# two rosters for a gym is the newer one. Starting from the clock keeps
+# rosters spooled before a restart older than the ones after it.
+roster_sequence = itertools.count(int(time.time() * 1000000))
+
 # This is used to store raid information to then put into gyms when
 # The wh arrives.  It's not the best way to do it. But it is a way.
 global_gyms = {}
 
 
+# The webhook senders give us far more than we keep in the database,
+# and each of them names things a little differently. These turn a
+# webhook message into a database row; there's one per webhook type and
+# sender, built once here instead of on every message.
+
+def gmtime_ms(value):
+    # RM sends most of its timestamps in ms.
+    return time.gmtime(value / 1000)
+
+
+def gym_url(url):
+    # DB needs something not NULL
+    return url if url is not None else "http://notgiven.com"
+
+
+def pokemon_cp_multiplier(message):
+    # pgscout/monocle hack for level/cpm
+    if message.get('pokemon_level') is not None:
+        return cpm[message['pokemon_level']]
+    if message.get('level') is not None:
+        return cpm[message['level']]
+    return message.get('cp_multiplier')
+
+
+def raid_boss(column):
+    # Mon alt sends 0 until the egg hatches, those need to be None.
+    def boss(message):
+        if message['cp'] == 0:
+            return None
+        return message.get(column, MISSING)
+    return boss
+
+
+def monocle_gym_park(message):
+    # Mon alt only tells us about parks in the raid info.
+    raid = global_gyms.get(message['gym_id'])
+    if raid is None:
+        return message.get('park', MISSING)
+    return raid['park'] not in ('None', None)
+
+
+pokemon_columns = ["encounter_id", "spawnpoint_id", "pokemon_id", "latitude",
+                   "longitude", "disappear_time", "individual_attack",
+                   "individual_defense", "individual_stamina", "move_1",
+                   "move_2", "weight", "height", "gender", "form", "cp",
+                   "cp_multiplier", "last_modified", "costume",
+                   "weather_boosted_condition"]
+rm_pokemon = Projector(
+    Pokemon, pokemon_columns,
+    converters={'disappear_time': time.gmtime},
+    computed={'cp_multiplier': pokemon_cp_multiplier},
+    # if people are running an older DB version sending wh:
+    defaults={'form': None, 'cp': None, 'cp_multiplier': None})
+monocle_pokemon = Projector(
+    Pokemon, pokemon_columns,
+    renames={'weather_boosted_condition': 'boosted_weather'},
+    converters={'disappear_time': time.gmtime},
+    computed={'cp_multiplier': pokemon_cp_multiplier},
+    defaults={'form': None, 'cp': None, 'cp_multiplier': None})
+
+# Several scanners see the same spawns. last_modified is when the sender
+# saw it, which doesn't make a copy any different.
+encounters = EncounterCache('Encounters', ignored=('last_modified',))
+
+# They also resend every gym, pokestop and weather cell they pass, mostly
+# unchanged. A pokestop's last_updated is just when it was scanned.
+pokestop_fingerprints = FingerprintCache(
+    'Pokestops', args.fingerprint_cache_size, args.fingerprint_refresh,
+    ignored=('last_updated',))
+gym_fingerprints = FingerprintCache(
+    'Gyms', args.fingerprint_cache_size, args.fingerprint_refresh)
+weather_fingerprints = FingerprintCache(
+    'Weather', args.fingerprint_cache_size, args.fingerprint_refresh)
+
+# And gym details, whose defenders rarely change between scans.
+rosters = RosterCache(
+    'Rosters', args.fingerprint_cache_size, args.roster_refresh)
+
+# last_modified is DB, last_modified_time is WH
+rm_pokestop = Projector(
+    Pokestop, ["pokestop_id", "enabled", "latitude", "longitude",
+               "last_modified", "lure_expiration", "active_fort_modifier",
+               "last_updated"],
+    renames={'last_modified': 'last_modified_time'},
+    converters={'last_modified': gmtime_ms,
+                'lure_expiration':
+                    lambda v: gmtime_ms(v) if v is not None else None})
+
+gym_columns = ["gym_id", "team_id", "guard_pokemon_id", "slots_available",
+               "enabled", "latitude", "longitude", "total_cp", "park",
+               "sponsor", "last_modified"]
+rm_gym = Projector(
+    Gym, gym_columns,
+    converters={'last_modified': gmtime_ms})
+monocle_gym = Projector(
+    Gym, gym_columns,
+    renames={'team_id': 'team'},
+    converters={'last_modified': time.gmtime},
+    computed={'park': monocle_gym_park},
+    constants={'enabled': True})
+
+gymdetails_columns = ["gym_id", "name", "description", "url"]
+rm_gymdetails = Projector(
+    GymDetails, gymdetails_columns,
+    renames={'gym_id': 'id'},
+    converters={'url': gym_url})
+monocle_gymdetails = Projector(
+    GymDetails, gymdetails_columns,
+    renames={'description': 'name'},
+    # I found a gym that doesn't send a name, so we'll put this here.
+    converters={'url': gym_url,
+                'name': lambda v: v if v is not None else "None"})
+
+gympokemon_columns = ["pokemon_uid", "pokemon_id", "cp", "trainer_name",
+                      "num_upgrades", "move_1", "move_2", "height", "weight",
+                      "stamina", "stamina_max", "cp_multiplier",
+                      "additional_cp_multiplier", "iv_defense", "iv_stamina",
+                      "iv_attack", "costume", "form", "shiny"]
+rm_gympokemon = Projector(GymPokemon, gympokemon_columns)
+monocle_gympokemon = Projector(
+    GymPokemon, gympokemon_columns,
+    renames={'pokemon_uid': 'external_id',
+             'trainer_name': 'owner_name',
+             'iv_defense': 'def_iv',
+             'iv_attack': 'atk_iv',
+             'iv_stamina': 'sta_iv'},
+    constants={'height': 0, 'weight': 0, 'cp_multiplier': 0,
+               'additional_cp_multiplier': 0})
+
+raid_columns = ["pokemon_id", "spawn", "move_1", "move_2", "end", "level",
+                "gym_id", "start", "cp"]
+# always set spawn time
+rm_raid = Projector(
+    Raid, raid_columns,
+    converters={'start': time.gmtime, 'end': time.gmtime},
+    computed={'spawn': lambda m: time.gmtime(m['start'] - 3600)})
+monocle_raid = Projector(
+    Raid, raid_columns,
+    renames={'start': 'raid_begin', 'end': 'raid_end'},
+    converters={'start': time.gmtime, 'end': time.gmtime},
+    computed={'spawn': lambda m: time.gmtime(m['raid_begin'] - 3600),
+              'cp': raid_boss('cp'),
+              'pokemon_id': raid_boss('pokemon_id'),
+              'move_1': raid_boss('move_1'),
+              'move_2': raid_boss('move_2')})
+
+# The coordinates are filled in from the S2 cell. The levels are a WAG
+# until I get more info.
+monocle_weather = Projector(
+    Weather, ["s2_cell_id", "latitude", "longitude", "cloud_level",
+              "rain_level", "snow_level", "fog_level", "wind_direction",
+              "gameplay_weather", "severity", "warn_weather", "world_time",
+              "last_updated"],
+    # Day =1 night = 2
+    renames={'severity': 'alert_severity', 'warn_weather': 'warn',
+             'world_time': 'day', 'gameplay_weather': 'condition',
+             'last_updated': 'time_changed'},
+    converters={'last_updated': time.gmtime},
+    constants={'cloud_level': 0, 'rain_level': 0, 'snow_level': 0,
+               'fog_level': 0, 'wind_direction': 0})
+
+
 class Auth():
     authorizations = {}
     auth_stats = {}
@@ -75,6 +258,7 @@ class Auth():
                 self.authorizations[data.token] = data.name
                 if data.token not in self.auth_stats:
                     self.auth_stats[data.token] = 0
+            db.release()
 
             if args.runtime_statistics:
                 stats_queue.put(('authorizations', self.authorizations))
@@ -100,6 +284,23 @@ class Auth():
         return True
 
 
+def decode_payload(data_string):
+    # Returns the name of the parser that succeeded and the decoded data.
+    # Strict JSON first, YAML is only kept around for anything that
+    # isn't valid JSON.
+    try:
+        return json_engine.__name__, json_engine.loads(data_string)
+    except ValueError:
+        pass
+
+    # YAML is puking on quoted unicode strings.
+    try:
+        return 'yaml', yaml.load(data_string, Loader=Loader)
+    except yaml.scanner.ScannerError:
+        # try with the regular loader
+        return 'yaml-py', yaml.load(data_string)
+
+
 def sizeof_fmt(num, suffix='B'):
     for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
         if abs(num) < 1024.0:
@@ -108,6 +309,109 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+def queue_stats():
+    spool = get_spool()
+    watermarks = {'Process': process_queue.watermark_state(),
+                  'DB': db_queue.watermark_state()}
+    for shard in shards:
+        watermarks['DB ' + shard.name] = shard.queue.watermark_state()
+    return {'process': process_queue.qsize(),
+            'db': db_queue.qsize(),
+            'wh': wh_queue.qsize(),
+            'spool': spool.backlog if spool is not None else 0,
+            'pool': db.pool_stats(),
+            'shards': {shard.name: {'queue': shard.queue.qsize(),
+                                    'pool': shard.db.pool_stats()}
+                       for shard in shards},
+            'watermarks': watermarks}
+
+
+# Stats that are sent as running totals rather than increments. When
+# they come from several ingest workers, the latest value of each worker
+# is kept and the combined value is reported.
+summed_stats = ['auth_stats', 'posts', 'queues', 'caches']
+maxed_stats = ['db_queue_max', 'process_queue_max', 'wh_queue_max']
+
+# The summed stats that count things. A restarted worker counts from zero
+# again, so what its predecessor counted is carried forward. The others
+# (queue sizes, cache sizes) go away with the worker.
+carried_stats = ['auth_stats', 'posts', 'caches']
+
+
+def sum_stats(values):
+    if isinstance(values[0], dict):
+        keys = set().union(*values)
+        return {key: sum_stats([v[key] for v in values if key in v])
+                for key in keys}
+    if isinstance(values[0], bool):
+        return any(values)
+    return sum(values)
+
+
+def forward_stats(stream):
+    # Runs in an ingest worker: ships our stats to the supervisor, one
+    # JSON document per line.
+    last_queues = 0
+    while (True):
+        try:
+            stat, data = stats_queue.get(timeout=5)
+        except Empty:
+            pass
+        else:
+            stream.write(json.dumps((stat, data)) + '\n')
+            stats_queue.task_done()
+
+        if time.time() - last_queues > 5:
+            last_queues = time.time()
+            stream.write(json.dumps(('queues', queue_stats())) + '\n')
+        stream.flush()
+
+
+def counts(stat, data):
+    # What's left of a stat once its sender is gone.
+    if stat == 'caches':
+        return {name: {key: value for key, value in cache.iteritems()
+                       if key != 'size'}
+                for name, cache in data.iteritems()}
+    return data
+
+
+class WorkerStats():
+    latest = {}
+    # Totals of the workers that were replaced, per carried stat.
+    carried = {}
+    lock = Lock()
+
+    def collect(self, worker, stream):
+        # Runs in the supervisor, one thread per ingest worker, started
+        # again for every new process in that slot.
+        with self.lock:
+            for stat in summed_stats:
+                data = self.latest.get(stat, {}).pop(worker, None)
+                if data is not None and stat in carried_stats:
+                    self.carried[stat] = sum_stats(
+                        [counts(stat, data)] +
+                        ([self.carried[stat]] if stat in self.carried
+                         else []))
+
+        for line in iter(stream.readline, ''):
+            stat, data = json.loads(line)
+            if stat in summed_stats or stat in maxed_stats:
+                with self.lock:
+                    workers = self.latest.setdefault(stat, {})
+                    workers[worker] = data
+                    if stat in maxed_stats:
+                        data = max(workers.values())
+                    else:
+                        data = sum_stats(
+                            workers.values() +
+                            ([self.carried[stat]] if stat in self.carried
+                             else []))
+
+            stats_queue.put((stat, data))
+        stream.close()
+
+
 def process_stats():
     start_time = time.time()
     stat_time = start_time
@@ -124,7 +428,23 @@ def process_stats():
     max_db_queue = 0
     max_wh_queue = 0
     max_process_queue = 0
-    bytes = 0
+    bytes_received = 0
+    bytes_decoded = 0
+    db_batches = 0
+    db_commits = 0
+    db_sessions = 0
+    db_round_trips_saved = 0
+    dead_letters = 0
+    purged = 0
+    purge_seconds = 0.0
+    purge_pauses = 0
+    expired = {}
+    spooled = 0
+    replayed = 0
+    # parser name -> [payloads decoded, total seconds spent]
+    decoders = {}
+    worker_queues = None
+    caches = {}
 
     while (True):
             # we're just going to block here until we get data
@@ -163,14 +483,53 @@ def process_stats():
         if stat == "wh_queue_max":
             max_wh_queue = data
 
+        if stat == "db_commits":
+            db_batches += data
+            db_commits += 1
+
+        if stat == "db_sessions":
+            db_sessions += data
+
+        if stat == "db_round_trips_saved":
+            db_round_trips_saved += data
+
+        if stat == "dead_letters":
+            dead_letters += data
+
+        if stat == "purge":
+            purged += data[0]
+            purge_seconds += data[1]
+            purge_pauses += data[2]
+
+        if stat == "spool":
+            spooled += data[0]
+            replayed += data[1]
+
+        if stat == "expired":
+            for kind, count in data.items():
+                expired[kind] = expired.get(kind, 0) + count
+
         if stat == "bytes":
-            bytes = data
+            bytes_received += data[0]
+            bytes_decoded += data[1]
+
+        if stat == "decode":
+            parser, elapsed = data
+            decoder = decoders.setdefault(parser, [0, 0.0])
+            decoder[0] += 1
+            decoder[1] += elapsed
+
+        if stat == "caches":
+            caches = data
 
         stats_queue.task_done()
 
-        wh_q_size = wh_queue.qsize()
-        process_q_size = process_queue.qsize()
-        db_q_size = db_queue.qsize()
+        if stat == "queues":
+            worker_queues = data
+
+        # In pre-fork mode our own queues are idle, the workers report
+        # theirs instead.
+        queues = worker_queues or queue_stats()
 
         # run the stats
         if time.time() - stat_time > args.runtime_statistics * 60:
@@ -178,7 +537,8 @@ def process_stats():
             log.info("--- Runtime Statistics ---")
             log.info("Success/Fails: [%i,%i]", post_success,
                      post_fails)
-            log.info("Bytes Received: %s", sizeof_fmt(bytes))
+            log.info("Bytes Received: %s (%s uncompressed)",
+                     sizeof_fmt(bytes_received), sizeof_fmt(bytes_decoded))
             log.info("Pokemon: %i", pokemon_total)
             log.info("Pokestops %i", pokestop_total)
             log.info("Gyms: %i", gym_total)
@@ -186,6 +546,15 @@ def process_stats():
             log.info("Raids: %i", raid_total)
             log.info("Weather: %i", weather_total)
             log.info("Ignored: %i", ignored)
+            if dead_letters:
+                log.info("Rejected by the database: %i", dead_letters)
+            if purge_seconds:
+                log.info("Purged: %i (%i/sec), paused %i times", purged,
+                         int(purged / purge_seconds), purge_pauses)
+            if expired:
+                log.info("Expired: %s", ', '.join(
+                    '%s %i' % (kind, expired[kind])
+                    for kind in sorted(expired)))
             log.info("Average requests per minute: %i",
                      int((post_success + post_fails) /
                          ((time.time() - start_time) / 60)))
@@ -196,19 +565,63 @@ def process_stats():
                     if auth_stats[token]:
                         log.info("%s: %i", auths[token], auth_stats[token])
 
+            log.info("--- Payload decoding (Count/Avg) ---")
+            for parser in sorted(decoders):
+                count, seconds = decoders[parser]
+                log.info("%-7s: %i (%.2fms)", parser, count,
+                         seconds * 1000 / count)
+
+            if caches:
+                log.info("--- Caches (Hits/Misses/Evictions) ---")
+            for name in sorted(caches):
+                cache = caches[name]
+                log.info("%-10s: %i/%i/%i, %i entries", name, cache['hits'],
+                         cache['misses'], cache['evictions'], cache['size'])
+
             log.info("--- Queue Info (Current/Max) ---")
-            log.info("Process: %i (%i)", process_q_size, max_process_queue)
+            log.info("Process: %i (%i)", queues['process'],
+                     max_process_queue)
             log.info("Stats  : %i (%i)", qsize, max_stat_queue)
-            log.info("DB     : %i (%i)", db_q_size, max_db_queue)
-            log.info("WH     : %i (%i)", wh_q_size, max_wh_queue)
+            log.info("DB     : %i (%i)", queues['db'], max_db_queue)
+            log.info("WH     : %i (%i)", queues['wh'], max_wh_queue)
+            if spooled or queues['spool']:
+                log.info("Spool  : %s, %i batches spooled, %i replayed",
+                         sizeof_fmt(queues['spool']), spooled, replayed)
+            log.info("DB commits: %i (%i batches)", db_commits, db_batches)
+            log.info("DB round trips saved per minute: %i (%i sessions "
+                     "set up)", int(db_round_trips_saved /
+                                    ((time.time() - start_time) / 60)),
+                     db_sessions)
+            pool = queues['pool']
+            log.info("DB pool: %i in use, %i idle, waited %i times "
+                     "(%.1fms avg), %.1f reconnects per minute",
+                     pool['in_use'], pool['idle'], pool['waits'],
+                     pool['wait_time'] * 1000 / max(pool['waits'], 1),
+                     pool['reconnects'] / ((time.time() - start_time) / 60))
+            for name in sorted(queues['shards']):
+                shard = queues['shards'][name]
+                log.info("DB shard %s: queue %i, %i in use, %i idle, "
+                         "waited %i times", name, shard['queue'],
+                         shard['pool']['in_use'], shard['pool']['idle'],
+                         shard['pool']['waits'])
+
+            log.info("--- Queue Watermarks (High/Low) ---")
+            for name in ['Process', 'DB'] + sorted(
+                    name for name in queues['watermarks']
+                    if name.startswith('DB ')):
+                state = queues['watermarks'][name]
+                if not state['high']:
+                    log.info("%-7s: unbounded", name)
+                    continue
+                log.info("%-7s: %i/%i, %s, saturated %i times, "
+                         "%i requests turned away.", name, state['high'],
+                         state['low'],
+                         'saturated' if state['saturated'] else 'accepting',
+                         state['saturations'], state['rejected'])
 
 
 class ProcessHook():
 
-    # used for bulk imports
-    pokemon_iteration = args.pokemon_inserts
-    pokemon_counter = 0
-
     # total stats
     pokemon_total = 0
     pokestop_total = 0
@@ -217,8 +630,6 @@ class ProcessHook():
     ignored = 0
     raid_total = 0
     weather_total = 0
-    # to hold multiple pokemon for bulk insertions
-    pokemon_list = {}
 
     def __init__(self):
         if args.runtime_statistics:
@@ -237,6 +648,7 @@ class ProcessHook():
                      'ignored': self.ignored
                      }
             stats_queue.put(('stats', stats))
+            stats_queue.put(('caches', cache_stats()))
             self.reset_stats()
             time.sleep(random.randint(5, 8))
 
@@ -246,75 +658,37 @@ class ProcessHook():
         self.pokemon_total += 1
         if args.no_pokemon:
             return
-        # more items come from the webhook than we need in the database.
-        # since the webhook output can change at any time to add fields,
-        # we'll make a list based on database tables.  This will change with DB
-        # schema changes
-        to_keep = ["encounter_id", "spawnpoint_id", "pokemon_id", "latitude",
-                   "longitude", "disappear_time", "individual_attack",
-                   "individual_defense", "individual_stamina", "move_1",
-                   "move_2", "weight", "height", "gender", "form", "cp",
-                   "cp_multiplier", "last_modified", "costume",
-                   "weather_boosted_condition"]
-        pokemon = {}
+
         enc = json_data['encounter_id']
-        pokemon[enc] = json_data
-        if pokemon[enc]['pokemon_id'] in args.ignore_pokemon:
+        if json_data['pokemon_id'] in args.ignore_pokemon:
             self.ignored += 1
             return
 
-        # copy this for webhook forwarding
-        wh_poke = pokemon[enc].copy()
-#        pprint.pprint(pokemon[enc])
-        # pgscout/monocle hack for level/cpm
-        if "level" in pokemon[enc] and pokemon[enc]['level'] is not None:
-            log.debug("Got a level: %i. CPM: %f",
-                      pokemon[enc]['level'], cpm[pokemon[enc]['level']])
-            pokemon[enc].update({'cp_multiplier': cpm[pokemon[enc]['level']]})
-
-        if ("pokemon_level" in pokemon[enc] and
-                pokemon[enc]['pokemon_level'] is not None):
-            log.debug("Got a level: %i. CPM: %f",
-                      pokemon[enc]['pokemon_level'],
-                      cpm[pokemon[enc]['pokemon_level']])
-            pokemon[enc].update({'cp_multiplier':
-                                 cpm[pokemon[enc]['pokemon_level']]})
-
-        # if people are running an older DB version sending wh:
-        if "form" not in pokemon[enc]:
-            pokemon[enc].update({'form': None})
-        if "cp" not in pokemon[enc]:
-            pokemon[enc].update({'cp': None})
-        if "cp_multiplier" not in pokemon[enc]:
-            pokemon[enc].update({'cp_multiplier': None})
-
         # for mon alt
-        if 'boosted_weather' in pokemon[enc]:
-            pokemon[enc]['weather_boosted_condition'] = (
-                pokemon[enc]['boosted_weather'])
-
-        # need to change this from an epoch style type to
-        # datetime.dateime for the database insert
-        pokemon[enc].update({'disappear_time':
-                             time.gmtime(pokemon[enc]['disappear_time'])})
-        # copies all the keys we want for the DB
-        pokemon[enc] = {key: pokemon[enc][key]
-                        for key in pokemon[enc] if key in to_keep}
+        if 'boosted_weather' in json_data:
+            pokemon = {enc: monocle_pokemon(json_data)}
+        else:
+            pokemon = {enc: rm_pokemon(json_data)}
+
+        # Another scanner already sent us exactly this, it's stored and
+        # forwarded already.
+        if (not args.no_encounter_cache and
+                encounters.duplicate(enc, pokemon[enc],
+                                     json_data.get('disappear_time', 0))):
+            return
+
         log.debug("%s", pokemon)
-        # multiple sources at the time with the same encounter id?
-        # I don't know... but just in case
-        if enc not in self.pokemon_list:
-            self.pokemon_list[enc] = pokemon[enc]
-
-        self.pokemon_counter += 1
-
-        # put it into the db queue
-        if self.pokemon_counter % self.pokemon_iteration == 0:
-            db_queue.put((Pokemon, self.pokemon_list))
-            self.pokemon_counter = 0
-            self.pokemon_list = {}
+        # add it to the batch for the db queue
+        queue_rows(Pokemon, pokemon)
+        if (args.purge_data > 0 and not args.pokemon_partitions and
+                args.worker_id is None):
+            # One purge for every minute's worth of spawns. Ingest
+            # workers leave the purge to the supervisor.
+            minute = int(json_data.get('disappear_time', 0)) // 60 * 60 + 60
+            expiries.schedule('pokemon', minute,
+                              minute + args.purge_data * 3600)
         if args.webhooks:
-            wh_queue.put(('pokemon', wh_poke))
+            wh_queue.put(('pokemon', json_data))
 
     def process_pokestop(self, json_data):
         # Increase the # of pokestops received, even if it's not stored
@@ -323,148 +697,79 @@ class ProcessHook():
         if args.no_pokestops:
             return
 
-        to_keep = ["pokestop_id", "enabled", "latitude", "longitude",
-                   "last_modified", "lure_expiration", "active_fort_modifier",
-                   "last_updated"]
-        pokestop = {}
-        id = json_data['pokestop_id']
-        pokestop[id] = json_data
-        # copy this for webhook forwarding
-        wh_pokestop = pokestop[id].copy()
-        # last_modified is DB, last_modified_time is WH
-        if pokestop[id]['lure_expiration'] is not None:
-            pokestop[id].update({'lure_expiration':
-                                 time.gmtime(pokestop[id]['lure_expiration']
-                                             / 1000)})
-        pokestop[id].update({'last_modified':
-                             time.gmtime(
-                                 pokestop[id]['last_modified_time'] / 1000),
-                             'pokestop_id': pokestop[id]['pokestop_id']})
-        # copies all the keys we want for the DB
-        pokestop[id] = {key: pokestop[id][key]
-                        for key in pokestop[id] if key in to_keep}
+        pokestop = {json_data['pokestop_id']: rm_pokestop(json_data)}
+        if json_data.get('lure_expiration'):
+            expiries.schedule('lure', json_data['pokestop_id'],
+                              json_data['lure_expiration'] / 1000.0)
 
         log.debug("%s", pokestop)
-        # put it into the db queue
-        db_queue.put((Pokestop, pokestop))
+        # add it to the batch for the db queue, unless it's what we
+        # already have
+        if pokestop_fingerprints.changed(json_data['pokestop_id'],
+                                         pokestop[json_data['pokestop_id']]):
+            queue_rows(Pokestop, pokestop)
         if args.webhooks:
-            wh_queue.put(('pokestop', wh_pokestop))
+            wh_queue.put(('pokestop', json_data))
 
     def process_gym(self, json_data):
-        global global_gyms
         # Increase the # of gyms received, even if it's not stored
         self.gym_total += 1
         if args.no_gyms:
             return
 
-        to_keep = ["gym_id", "team_id", "guard_pokemon_id",
-                   "slots_available", "enabled", "latitude", "longitude",
-                   "total_cp", "park", "sponsor", "last_modified"]
-
-        gym = {}
-        # copy this for webhook forwarding
-        wh_gym = json_data.copy()
-
+        id = json_data['gym_id']
         # This is for mon alt's fork, which is almost like RM
         # But has this field, which can be used to identify it.
         if 'gym_defenders' in json_data:
-            id = json_data['gym_id']
-            gym[id] = json_data.copy()
-            gym[id].update({'enabled': True,
-                            'team_id': gym[id]['team'],
-                            'gym_id': gym[id]['gym_id'],
-                            'last_modified':
-                                time.gmtime(gym[id]['last_modified'])})
+            gym = {id: monocle_gym(json_data)}
             # now send the whole json data to the details.
-
-            if id in global_gyms:
-                if (global_gyms[id]['park'] == 'None' or
-                        global_gyms[id]['park'] is None):
-                    gym[id]['park'] = False
-                else:
-                    gym[id]['park'] = True
-
             self.process_gym_details(json_data)
         else:
-            id = json_data['gym_id']
-            gym[id] = json_data.copy()
-            gym[id].update({'gym_id': gym[id]['gym_id'],
-                            'last_modified':
-                                time.gmtime(gym[id]['last_modified'] / 1000)})
-
-        # copies all the keys we want for the DB
-        gym[id] = {key: gym[id][key] for key in gym[id] if key in to_keep}
+            gym = {id: rm_gym(json_data)}
 
         log.debug("%s", gym)
-        # put it into the db queue
-        db_queue.put((Gym, gym))
+        # add it to the batch for the db queue, unless it's what we
+        # already have
+        if gym_fingerprints.changed(id, gym[id]):
+            queue_rows(Gym, gym)
         if args.webhooks:
-            wh_queue.put(('gym', wh_gym))
-
-    def process_gympokemon(self, id, monkey, gymdetails):
-        to_keep = ["pokemon_uid", "pokemon_id", "cp", "trainer_name",
-                   "num_upgrades", "move_1", "move_2", "height", "weight",
-                   "stamina",  "stamina_max", "cp_multiplier",
-                   "additional_cp_multiplier", "iv_defense", "iv_stamina",
-                   "iv_attack", "costume", "form", "shiny"]
+            wh_queue.put(('gym', json_data))
+
+    def process_gympokemon(self, id, monkey, json_data):
         gym_pokemon = {}
         gym_members = {}
         trainers = {}
 
         if monkey is False:
-            whpokemon = gymdetails[id]['pokemon']
+            whpokemon = json_data['pokemon']
+            project = rm_gympokemon
         else:
-            whpokemon = gymdetails[id]['gym_defenders']
+            whpokemon = json_data['gym_defenders']
+            project = monocle_gympokemon
 
         for pokemon in whpokemon:
             if monkey is False:
                 trainers[pokemon['trainer_name']] = {
                     'name': pokemon['trainer_name'],
-                    'team': gymdetails[id]['team'],
+                    'team': json_data['team'],
                     'level': pokemon['trainer_level']}
                 p_uid = pokemon['pokemon_uid']
+                cp_decayed = pokemon['cp_decayed']
             else:
                 trainers[pokemon['owner_name']] = {
                     'name': pokemon['owner_name'],
-                    'team': gymdetails[id]['team'],
+                    'team': json_data['team'],
                     'level': pokemon['owner_level']}
                 p_uid = pokemon['external_id']
+                cp_decayed = pokemon['cp']
 
-            if 'deployment_time' not in pokemon:
-                pokemon['deployment_time'] = time.time()
-
-            # Assign the pokemon receveived, and we'll update it as needed
-            # for field mapping
-            gym_pokemon[p_uid] = pokemon
-            if monkey is False:
-                gym_members[p_uid] = {'gym_id': gymdetails[id]['gym_id'],
-                                      'pokemon_uid': p_uid,
-                                      'cp_decayed': pokemon['cp_decayed'],
-                                      'deployment_time':
-                                          time.gmtime(
-                                              pokemon['deployment_time'])}
-                gym_pokemon[p_uid] = pokemon
-            else:
-                gym_members[p_uid] = {'gym_id': gymdetails[id]['gym_id'],
-                                      'pokemon_uid': p_uid,
-                                      'cp_decayed': pokemon['cp'],
-                                      'deployment_time':
-                                          time.gmtime(
-                                              pokemon['deployment_time'])}
-
-                gym_pokemon[p_uid].update({'pokemon_uid': p_uid,
-                                           'trainer_name':
-                                               pokemon['owner_name'],
-                                           'height': 0, 'weight': 0,
-                                           'cp_multiplier': 0,
-                                           'additional_cp_multiplier': 0,
-                                           'iv_defense': pokemon['def_iv'],
-                                           'iv_attack': pokemon['atk_iv'],
-                                           'iv_stamina': pokemon['sta_iv']})
-
-            gym_pokemon[p_uid] = {key: gym_pokemon[p_uid][key]
-                                  for key in gym_pokemon[p_uid]
-                                  if key in to_keep}
+            gym_members[p_uid] = {'gym_id': id,
+                                  'pokemon_uid': p_uid,
+                                  'cp_decayed': cp_decayed,
+                                  'deployment_time':
+                                      time.gmtime(pokemon.get(
+                                          'deployment_time', time.time()))}
+            gym_pokemon[p_uid] = project(pokemon)
 
         return gym_pokemon, gym_members, trainers
 
@@ -477,61 +782,41 @@ class ProcessHook():
         if 'gym_defenders' in json_data:
             monkey = True
 
-        to_keep = ["gym_id", "name", "description", "url"]
-
-        gymdetails = {}
-
         if monkey is False:
-            id = json_data['id']
-            gymdetails[id] = json_data
-            # copy this for webhook forwarding
-            wh_gymdetails = gymdetails[id].copy()
             # the wh sends "id", the but the database
             # wants gym_id
-            gymdetails[id].update({'gym_id': gymdetails[id]['id']})
-
-        if monkey is True:
+            id = json_data['id']
+            gymdetails = {id: rm_gymdetails(json_data)}
+        else:
             id = json_data['gym_id']
-            gymdetails[id] = json_data
-            wh_gymdetails = gymdetails[id].copy()
-            gymdetails[id].update({
-                'gym_id': id,
-                'name': gymdetails[id]['name'],
-                'description': gymdetails[id]['name'],
-                'url': gymdetails[id]['url']})
-            # I found a gym that doesn't send a name, so we'll put this here.
-            if gymdetails[id]['name'] is None:
-                gymdetails[id].update({'name': "None"})
-
-        # DB needs something not NULL
-        if json_data['url'] is None:
-            gymdetails[id]['url'] = "http://notgiven.com"
+            gymdetails = {id: monocle_gymdetails(json_data)}
 
         # we need to extract trainer and pokemon information before
         # getting gymdetails ready for the database
 
         (gym_pokemon,
          gym_members,
-         trainers) = self.process_gympokemon(id, monkey, gymdetails)
+         trainers) = self.process_gympokemon(id, monkey, json_data)
 
-        # copies all the keys we want for the DB
-        gymdetails[id] = {key: gymdetails[id][key] for key in gymdetails[id]
-                          if key in to_keep}
+        # Only keep what changed since we last saw this gym.
+        (gym_pokemon,
+         gym_members,
+         trainers) = rosters.changes(id, gym_pokemon, gym_members, trainers)
 
         log.debug("%s", gymdetails)
-        # put it all into the db queue
-        db_queue.put((GymDetails, gymdetails))
-        db_queue.put((Trainer, trainers))
-        db_queue.put((GymPokemon, gym_pokemon))
+        # add it all to the batches for the db queue
+        queue_rows(GymDetails, gymdetails)
+        if trainers:
+            queue_rows(Trainer, trainers)
+        if gym_pokemon:
+            queue_rows(GymPokemon, gym_pokemon)
 
-        # Need to delete gym members
-        DeleteQuery(GymMember).where(
-            GymMember.gym_id << gymdetails.keys()).execute()
-
-        db_queue.put((GymMember, gym_members))
+        # The gym members replace whatever roster the gym had before.
+        if gym_members is not None:
+            queue_rows(GymMember, {id: (next(roster_sequence), gym_members)})
 
         if args.webhooks:
-            wh_queue.put(('gym_details', wh_gymdetails))
+            wh_queue.put(('gym_details', json_data))
 
     def process_raid(self, json_data):
         global global_gyms
@@ -541,63 +826,40 @@ class ProcessHook():
         if args.no_raids:
             return
 
-        to_keep = ["pokemon_id", "spawn", "move_1", "move_2", "end",
-                   "level", "gym_id", "start", "cp"]
-
-        raid = {}
-
         # This is for mon alt's fork. It's almost RM, but not quite.
         # 02/25/18
         # Mon alt added gym_id AND base64_gym_id,so this was breaking
         # and I just had to switch the checks around
         # Looks like he also changed the raid dictionary objects
         if 'base64_gym_id' in json_data:
-            id = json_data['raid_seed']
-            raid[id] = json_data
-            wh_raid = raid[id].copy()
-
-            # Map all the fields
-            raid[id]['gym_id'] = json_data['gym_id']
-            raid[id]['spawn'] = raid[id]['raid_begin'] - 3600
-            raid[id]['start'] = raid[id]['raid_begin']
-            raid[id]['end'] = raid[id]['raid_end']
-
-            # if we're getting 0, they need to be set to None
-            if raid[id]['cp'] == 0:
-                raid[id].update({'cp': None,
-                                 'pokemon_id': None,
-                                 'move_1': None,
-                                 'move_2': None})
-
-            global_gyms[raid[id]['gym_id']] = raid[id]
+            id = json_data['gym_id']
+            project = monocle_raid
+            global_gyms[json_data['gym_id']] = json_data
 
         # And this is stock RM
         elif 'gym_id' in json_data:
             # standard RM wh
             id = json_data['gym_id']
-            raid[id] = json_data
-            wh_raid = raid[id].copy()
-            # always set spawn time
-            raid[id]['spawn'] = raid[id]['start'] - 3600
+            project = rm_raid
+        else:
+            log.info("Received a raid without a gym.")
+            return
 
         try:
-            raid[id].update({'gym_id': raid[id]['gym_id'],
-                             'spawn': time.gmtime(raid[id]['spawn']),
-                             'start': time.gmtime(raid[id]['start']),
-                             'end': time.gmtime(raid[id]['end'])})
+            raid = {id: project(json_data)}
         except TypeError:
             log.info("There was an error decoding the raid info.")
-            log.info("%", raid)
+            log.info("%s", json_data)
             return
-        # copies all the keys we want for the DB
-        raid[id] = {key: raid[id][key]
-                    for key in raid[id] if key in to_keep}
 
         log.debug("%s", raid)
-        # put it into the db queue
-        db_queue.put((Raid, raid))
+        # add it to the batch for the db queue
+        queue_rows(Raid, raid)
+        end = json_data.get('end', json_data.get('raid_end'))
+        if end:
+            expiries.schedule('raid', id, end)
         if args.webhooks:
-            wh_queue.put(('raid', wh_raid))
+            wh_queue.put(('raid', json_data))
 
     def process_weather(self, json_data):
         self.weather_total += 1
@@ -605,57 +867,30 @@ class ProcessHook():
         if args.no_weather:
             return
 
-        to_keep = ["s2_cell_id", "latitude", "longitude", "cloud_level",
-                   "rain_level", "snow_level", "fog_level", "wind_direction",
-                   "gameplay_weather", "severity", "warn_weather",
-                   "world_time", "last_updated"]
-
-        weather = {}
-
         # This is for mon alt's fork. It's almost RM, but not quite.
         # As if this writing, RM doesn't have support for weather
         # 02/28/18
-        if 'coords' in json_data:
-            id = json_data['s2_cell_id']
-            weather[id] = json_data
-            wh_weather = weather[id].copy()
-
-            # Map all the fields
-            weather[id]['severity'] = json_data['alert_severity']
-            weather[id]['last_updated'] = time.gmtime(
-                json_data['time_changed'])
-            weather[id]['warn_weather'] = json_data['warn']
-            # Day =1 night = 2
-            weather[id]['world_time'] = json_data['day']
-            # condition
-            weather[id]['gameplay_weather'] = json_data['condition']
-
-            # Mon alt sends the coordinates, but we do not actually need them.
-            cell_id = s2sphere.CellId(long(id))
-            cell = s2sphere.Cell(cell_id)
-            center = s2sphere.LatLng.from_point(cell.get_center())
-            weather[id]['latitude'] = center.lat().degrees
-            weather[id]['longitude'] = center.lng().degrees
-
-            # This is a WAG until I get more info
-            weather[id]['cloud_level'] = 0
-            weather[id]['rain_level'] = 0
-            weather[id]['snow_level'] = 0
-            weather[id]['fog_level'] = 0
-            weather[id]['wind_direction'] = 0
+        if 'coords' not in json_data:
+            log.debug("Ignoring weather that isn't from mon alt.")
+            return
 
-        # And this is stock RM
-        else:
-            pass
-        # copies all the keys we want for the DB
-        weather[id] = {key: weather[id][key]
-                       for key in weather[id] if key in to_keep}
+        id = json_data['s2_cell_id']
+        weather = {id: monocle_weather(json_data)}
+
+        # Mon alt sends the coordinates, but we do not actually need them.
+        cell_id = s2sphere.CellId(long(id))
+        cell = s2sphere.Cell(cell_id)
+        center = s2sphere.LatLng.from_point(cell.get_center())
+        weather[id]['latitude'] = center.lat().degrees
+        weather[id]['longitude'] = center.lng().degrees
 
         log.debug("%s", weather)
-        # put it into the db queue
-        db_queue.put((Weather, weather))
+        # add it to the batch for the db queue, unless it's what we
+        # already have
+        if weather_fingerprints.changed(id, weather[id]):
+            queue_rows(Weather, weather)
         if args.webhooks:
-            wh_queue.put(('weather', wh_weather))
+            wh_queue.put(('weather', json_data))
 
     def reset_stats(self):
         self.pokemon_total = 0
@@ -672,33 +907,23 @@ def main_process():
 
     PH = ProcessHook()
     max_queue_size = 0
-    bytes = 0
     while (True):
         data_string = process_queue.get()
         start = timeit.default_timer()
-        # YAML is puking on quoted unicode strings.
         # Making a catch all exception and ignoring it.  I don't have enough
         # data to solve this atm.
         try:
-            json_data = yaml.load(data_string, Loader=Loader)
-        except yaml.scanner.ScannerError:
-            # try with the regular loader
-            try:
-                json_data = yaml.load(data_string)
-            except:
-                exceptiondata = traceback.format_exc().splitlines()
-                log.info("YAML processing error: '%s', ", exceptiondata[-1])
-                continue
+            parser, json_data = decode_payload(data_string)
         except:
             exceptiondata = traceback.format_exc().splitlines()
-            log.info("YAML processing error: '%s', ", exceptiondata[-1])
+            log.info("Payload decoding error: '%s', ", exceptiondata[-1])
             continue
 
         elapsed = timeit.default_timer() - start
-        log.debug("YAML loaded in %.2fs.", elapsed)
+        log.debug("Payload decoded by %s in %.4fs.", parser, elapsed)
+        if args.runtime_statistics:
+            stats_queue.put(('decode', (parser, elapsed)))
         process_queue.task_done()
-        bytes += len(data_string)
-        stats_queue.put(("bytes", bytes))
 
         if process_queue.qsize() > max_queue_size:
             max_queue_size = process_queue.qsize()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Returned by computed columns that have nothing to store, so the column
+# is left out of the row and falls back to the model's default.
+MISSING = object()
+
+
+class Projector():
+    # Turns an incoming webhook message into a database row for one model.
+    #
+    # Everything about the mapping is worked out once, when the projector
+    # is built, so projecting a message is a single pass over the columns
+    # we want rather than a scan of every key the sender included.
+    #
+    #   columns:    the model fields to fill, anything else is dropped.
+    #   renames:    column -> key in the message it is read from.
+    #   converters: column -> function applied to the value read.
+    #   computed:   column -> function of the whole message, returning
+    #               the value or MISSING.
+    #   constants:  column -> value, always set.
+    #   defaults:   column -> value used when the message doesn't have it.
+    def __init__(self, model, columns, renames={}, converters={},
+                 computed={}, constants={}, defaults={}):
+        fields = [f.name for f in model._meta.sorted_fields]
+        for column in columns:
+            if column not in fields:
+                raise ValueError('%s has no column %s.' %
+                                 (model.__name__, column))
+
+        self.model = model
+        # Keep the model's column order.
+        self.columns = [f for f in fields if f in columns]
+
+        self.copied = []
+        self.converted = []
+        self.computed = []
+        self.constants = {}
+        self.defaults = []
+        for column in self.columns:
+            source = renames.get(column, column)
+            if column in constants:
+                self.constants[column] = constants[column]
+            elif column in computed:
+                self.computed.append((column, computed[column]))
+            elif column in converters:
+                self.converted.append((column, source, converters[column]))
+            else:
+                self.copied.append((column, source))
+
+            if column in defaults:
+                self.defaults.append((column, defaults[column]))
+
+    def __call__(self, message):
+        row = {column: message[source] for column, source in self.copied
+               if source in message}
+        for column, source, convert in self.converted:
+            if source in message:
+                row[column] = convert(message[source])
+        for column, compute in self.computed:
+            value = compute(message)
+            if value is not MISSING:
+                row[column] = value
+        if self.constants:
+            row.update(self.constants)
+        for column, default in self.defaults:
+            if column not in row:
+                row[column] = default
+        return row
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from peewee import Using
+from s2sphere import CellId, LatLng
+from models import db, shard_database, spooled_models, Authorizations, \
+    Versions
+from utils import get_args, get_queues, WatermarkQueue
+
+log = logging.getLogger(__name__)
+
+args = get_args()
+(db_queue, wh_queue, process_queue, stats_queue) = get_queues()
+
+# Rows of these carry their coordinates and can go to a --db-shard. The
+# others (gym details, rosters, raids...) stay in the main database.
+sharded_models = [model for model in spooled_models.values()
+                  if 'latitude' in model._meta.fields and
+                  'longitude' in model._meta.fields]
+
+# Everything create_tables() and drop_tables() touch.
+schema_models = list(spooled_models.values()) + [Authorizations, Versions]
+
+
+def bounding_box(spec):
+    # Two opposite corners, lat,lng,lat,lng.
+    lat1, lng1, lat2, lng2 = [float(value) for value in spec.split(',')]
+    south, north = min(lat1, lat2), max(lat1, lat2)
+    west, east = min(lng1, lng2), max(lng1, lng2)
+    return lambda lat, lng: south <= lat <= north and west <= lng <= east
+
+
+def s2_cells(spec):
+    # Cell tokens, of any level. s2sphere wants them as unicode.
+    cells = [CellId.from_token(unicode(token)) for token in spec.split(',')]
+
+    def contains(lat, lng):
+        leaf = CellId.from_lat_lng(LatLng.from_degrees(lat, lng))
+        return any(cell.contains(leaf) for cell in cells)
+    return contains
+
+
+areas = {'box': bounding_box, 's2': s2_cells}
+
+
+class Shard():
+    # Another database that takes the rows of one area, with its own
+    # pool, db queue, db threads and spool, so one server doesn't have
+    # to take every city's writes.
+    def __init__(self, spec):
+        self.name, area, url = spec.strip().split(':', 2)
+        kind, area = area.split('=', 1)
+        self.contains = areas[kind](area)
+        self.db = shard_database(url)
+        self.queue = WatermarkQueue(args.db_queue_high, args.db_queue_low)
+
+
+shards = [Shard(spec) for spec in args.db_shard]
+
+
+def shard_for(row):
+    # The shard the row's coordinates fall in, None for the main
+    # database.
+    lat = row.get('latitude')
+    lng = row.get('longitude')
+    if lat is None or lng is None:
+        return None
+    for shard in shards:
+        if shard.contains(lat, lng):
+            return shard
+    return None
+
+
+def targets():
+    # (database, db queue) of the main database and every shard.
+    return [(db, db_queue)] + [(shard.db, shard.queue) for shard in shards]
+
+
+def for_each_shard(function):
+    # Runs function(database) on every shard with the models bound to
+    # its database. Only while nothing else is using the models, at
+    # startup.
+    for shard in shards:
+        log.info('Database shard %s:', shard.name)
+        with Using(shard.db, schema_models, with_transaction=False):
+            function(shard.db)
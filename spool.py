@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import mmap
+import struct
+import time
+import zlib
+import cPickle as pickle
+
+from threading import Lock
+from utils import get_args, memoize
+
+log = logging.getLogger(__name__)
+
+args = get_args()
+
+
+class Spool():
+    # An append-only log on disk of batches the database couldn't take
+    # yet. Batches are appended to numbered segment files, each record
+    # being its length and crc32 followed by the pickled batch. The
+    # replayer reads them back in order and remembers how far it got in
+    # the checkpoint file, deleting segments once they're done.
+    #
+    # fsync: 'always' syncs every record, 'interval' at most once a
+    # second, 'never' leaves it to the OS. A record is written out to the
+    # OS right away in every case, so only losing power can lose it.
+    header = struct.Struct('!II')
+
+    def __init__(self, directory, segment_size, fsync='interval',
+                 use_mmap=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.use_mmap = use_mmap
+        self.lock = Lock()
+        self.file = None
+        self.written = 0
+        self.last_sync = 0
+        self.last_checkpoint = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        segments = self.segments()
+        # Never append to a segment from before, its last record could
+        # have been cut short.
+        self.write_segment = segments[-1] + 1 if segments else 1
+        self.read_segment, self.read_offset = self.load_checkpoint()
+        if self.read_segment not in segments:
+            later = [s for s in segments if s > self.read_segment]
+            self.read_segment = later[0] if later else self.write_segment
+            self.read_offset = 0
+
+        self.backlog = sum(os.path.getsize(self.path(s)) for s in segments
+                           if s >= self.read_segment) - self.read_offset
+        if self.backlog > 0:
+            log.info('Spool in %s has %d bytes to replay.', directory,
+                     self.backlog)
+
+    def path(self, segment):
+        return os.path.join(self.directory, '%020d.spool' % segment)
+
+    def segments(self):
+        return sorted(int(name[:-6]) for name in os.listdir(self.directory)
+                      if name.endswith('.spool') and name[:-6].isdigit())
+
+    def load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, 'checkpoint')) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (IOError, ValueError):
+            return 0, 0
+
+    def save_checkpoint(self, force=False):
+        now = time.time()
+        if not force and self.fsync != 'always' and now - \
+                self.last_checkpoint < 1:
+            return
+        self.last_checkpoint = now
+        path = os.path.join(self.directory, 'checkpoint')
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d\n' % (self.read_segment, self.read_offset))
+            f.flush()
+            if self.fsync != 'never':
+                os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    def pending(self):
+        return self.backlog > 0
+
+    def append(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        entry = self.header.pack(len(data), zlib.crc32(data) & 0xffffffff)
+        with self.lock:
+            if self.file is None or self.written >= self.segment_size:
+                self.roll()
+            self.file.write(entry + data)
+            self.file.flush()
+            self.written += len(entry) + len(data)
+            self.backlog += len(entry) + len(data)
+
+            now = time.time()
+            if self.fsync == 'always' or (self.fsync == 'interval' and
+                                          now - self.last_sync >= 1):
+                os.fsync(self.file.fileno())
+                self.last_sync = now
+
+    def roll(self):
+        if self.file is not None:
+            if self.fsync != 'never':
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.write_segment += 1
+        self.file = open(self.path(self.write_segment), 'ab')
+        self.written = 0
+
+    def records(self, segment, offset):
+        # Yields (bytes read, record) from offset on, stopping at the end
+        # of the segment or at a record that's incomplete or damaged.
+        with open(self.path(segment), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return
+            if self.use_mmap:
+                data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            else:
+                f.seek(offset)
+                data = f.read(size - offset)
+                size -= offset
+                offset = 0
+
+            start = offset
+            try:
+                while offset + self.header.size <= size:
+                    length, crc = self.header.unpack_from(data, offset)
+                    end = offset + self.header.size + length
+                    if end > size:
+                        break
+                    body = data[offset + self.header.size:end]
+                    if zlib.crc32(body) & 0xffffffff != crc:
+                        log.error('Damaged record in spool segment %d.',
+                                  segment)
+                        break
+                    yield end - start, pickle.loads(body)
+                    offset = end
+            finally:
+                if self.use_mmap:
+                    data.close()
+
+    def replay(self, write):
+        # Hands the spooled records to write() in order, until the spool
+        # is empty or write() returns False. Returns how many were done
+        # and whether we caught up.
+        count = 0
+        while True:
+            with self.lock:
+                segment = self.read_segment
+                start = self.read_offset
+                current = segment >= self.write_segment
+
+            if not os.path.exists(self.path(segment)):
+                if current:
+                    return count, True
+                with self.lock:
+                    self.read_segment += 1
+                    self.read_offset = 0
+                continue
+
+            for consumed, record in self.records(segment, start):
+                if not write(record):
+                    self.save_checkpoint(force=True)
+                    return count, False
+                count += 1
+                with self.lock:
+                    self.backlog -= start + consumed - self.read_offset
+                    self.read_offset = start + consumed
+                self.save_checkpoint()
+
+            if current:
+                # Caught up with the writer.
+                self.save_checkpoint(force=True)
+                return count, True
+
+            # Done with this segment. Anything left in it is damaged.
+            with self.lock:
+                self.backlog -= (os.path.getsize(self.path(segment)) -
+                                 self.read_offset)
+                self.read_segment += 1
+                self.read_offset = 0
+            self.save_checkpoint(force=True)
+            os.remove(self.path(segment))
+
+
+@memoize
+def get_spool(shard=None):
+    if not args.spool_dir:
+        return None
+
+    directory = args.spool_dir
+    # Every ingest worker has its own, and so does every --db-shard.
+    if args.worker_id is not None:
+        directory = os.path.join(directory, 'worker-%d' % args.worker_id)
+    if shard is not None:
+        directory = os.path.join(directory, 'shard-' + shard)
+    return Spool(directory, args.spool_segment_size * 1024 * 1024,
+                 args.spool_fsync, args.spool_mmap)
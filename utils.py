@@ -1,5 +1,7 @@
 import sys
 import os
+import re
+import sqlite3
 import configargparse
 from queue import Queue
 
@@ -17,11 +19,51 @@ def memoize(function):
     return wrapper
 
 
+class WatermarkQueue(Queue):
+    # A Queue that knows when it's falling behind. Once it grows past the
+    # high watermark it's considered saturated until it drains back down
+    # to the low watermark. A high watermark of 0 never saturates.
+    def __init__(self, high=0, low=0):
+        Queue.__init__(self)
+        self.high = high
+        self.low = low if low else int(high * 0.8)
+        self.saturated = False
+        self.saturations = 0
+        self.rejected = 0
+
+    def over_watermark(self):
+        if not self.high:
+            return False
+
+        with self.mutex:
+            size = self._qsize()
+            if self.saturated and size <= self.low:
+                self.saturated = False
+            elif not self.saturated and size >= self.high:
+                self.saturated = True
+                self.saturations += 1
+            return self.saturated
+
+    def reject(self):
+        with self.mutex:
+            self.rejected += 1
+
+    def watermark_state(self):
+        with self.mutex:
+            return {'high': self.high,
+                    'low': self.low,
+                    'saturated': self.saturated,
+                    'saturations': self.saturations,
+                    'rejected': self.rejected}
+
+
 @memoize
 def get_queues():
-    db_queue = Queue()
+    args = get_args()
+    db_queue = WatermarkQueue(args.db_queue_high, args.db_queue_low)
     wh_queue = Queue()
-    process_queue = Queue()
+    process_queue = WatermarkQueue(args.process_queue_high,
+                                   args.process_queue_low)
     stats_queue = Queue()
     return (db_queue, wh_queue, process_queue, stats_queue)
 
@@ -52,6 +94,13 @@ def get_args():
                         help='Clear the database tables, and recreate. ' +
                         'Does not delete the authorizations.',
                         action='store_true', default=False)
+    parser.add_argument('--db-type',
+                        help=('Type of database: MySQL, or SQLite for a ' +
+                              'single node without a database server.'),
+                        choices=['mysql', 'sqlite'], default='mysql')
+    parser.add_argument('--db-file',
+                        help='SQLite database file.',
+                        default='whserver.db')
     parser.add_argument('--db-name', help='Name of the database to be used.')
     parser.add_argument('--db-user', help='Username for the database.')
     parser.add_argument('--db-pass', help='Password for the database.')
@@ -62,6 +111,58 @@ def get_args():
                         help=('Number of db threads; increase if the db ' +
                               'queue falls behind.'),
                         type=int, default=2)
+    parser.add_argument('--db-max-connections',
+                        help=('Most database connections to keep open, ' +
+                              'per ingest worker and database (the main ' +
+                              'one and every --db-shard). 0 = one per db ' +
+                              'thread plus four for the other threads.'),
+                        type=int, default=0)
+    parser.add_argument('--db-pool-timeout',
+                        help=('Seconds a thread waits for a free database ' +
+                              'connection before giving up.'),
+                        type=float, default=30)
+    parser.add_argument('--db-stale-timeout',
+                        help=('Seconds after which an idle database ' +
+                              'connection is closed when it comes back ' +
+                              'to the pool.'),
+                        type=int, default=600)
+    parser.add_argument('--db-shard',
+                        help=('Write the pokemon, pokestops, gyms and ' +
+                              'weather of an area to another database, ' +
+                              'as name:area:url. The area is box=lat,lng,' +
+                              'lat,lng (two opposite corners) or s2=token' +
+                              '[,token...] (S2 cells), the url mysql://' +
+                              'user:pass@host:port/dbname or sqlite:///' +
+                              'path. Can be given more than once, the ' +
+                              'first area a row falls in wins. Rows ' +
+                              'outside them go to the main database.'),
+                        action='append', default=[])
+    parser.add_argument('--db-session',
+                        help=('Session variable set on every new database ' +
+                              'connection, as name=value, e.g. ' +
+                              'unique_checks=0. Can be given more than ' +
+                              'once. foreign_key_checks=0 is always set ' +
+                              'first.'),
+                        action='append', default=[])
+    parser.add_argument('--db-isolation-level',
+                        help=('Transaction isolation level of the database ' +
+                              'connections. default = server setting.'),
+                        choices=['read-uncommitted', 'read-committed',
+                                 'repeatable-read', 'serializable'],
+                        default=None)
+    parser.add_argument('--db-coalesce',
+                        help=('Most batches a db thread merges into one ' +
+                              'transaction when the db queue backs up.'),
+                        type=int, default=100)
+    parser.add_argument('--db-statement-latency',
+                        help=('Seconds an upsert statement should take. ' +
+                              'The rows per statement are adjusted to ' +
+                              'it.'),
+                        type=float, default=0.5)
+    parser.add_argument('--dead-letter-file',
+                        help=('File to append rows the database rejects ' +
+                              'to, one JSON object per line.'),
+                        default=None)
     parser.add_argument('--httpd-threads',
                         help=('Number of httpd threads.'),
                         type=int, default=100)
@@ -99,19 +200,159 @@ def get_args():
     parser.add_argument('-sh', '--safe-httpd',
                         help='Run a more conservative HTTPD service',
                         action='store_true', default=False)
+    parser.add_argument('--keepalive-timeout',
+                        help=('Seconds an idle HTTP/1.1 connection is ' +
+                              'kept open for the next webhook ' +
+                              '(0 closes after every request). Defaults ' +
+                              'to 15 with --async-httpd and 0 otherwise, ' +
+                              'where an idle connection holds one of ' +
+                              'the --httpd-threads.'),
+                        type=int, default=None)
+    parser.add_argument('--keepalive-requests',
+                        help=('Maximum number of webhooks accepted on one ' +
+                              'connection before it is closed.'),
+                        type=int, default=100)
+    parser.add_argument('--max-body-size',
+                        help=('Largest webhook body accepted, in MB, ' +
+                              'after decompression.'),
+                        type=int, default=32)
+    parser.add_argument('-ah', '--async-httpd',
+                        help=('Serve all HTTP connections from a single ' +
+                              'event-loop thread instead of ' +
+                              '--httpd-threads threads.'),
+                        action='store_true', default=False)
 
     parser.add_argument('-pd', '--purge-data',
                         help=('Clear Pokemon from database this many hours ' +
                               'after they disappear (0 to disable).'),
                         type=int, default=0)
+    parser.add_argument('--purge-batch',
+                        help=('Number of old Pokemon deleted at a time ' +
+                              'when purging.'),
+                        type=int, default=1000)
+    parser.add_argument('--purge-rate',
+                        help=('Most old Pokemon deleted per second when ' +
+                              'purging (0 for no limit).'),
+                        type=int, default=5000)
+    parser.add_argument('--purge-max-db-queue',
+                        help=('Pause purging while more than this many ' +
+                              'batches are waiting for the database.'),
+                        type=int, default=10)
+    parser.add_argument('--purge-max-latency',
+                        help=('Pause purging while database writes take ' +
+                              'longer than this many seconds.'),
+                        type=float, default=1.0)
+    parser.add_argument('--pokemon-partitions',
+                        help=('Partition the pokemon table by disappear ' +
+                              'time, so --purge-data can drop whole ' +
+                              'partitions. Converting an existing table ' +
+                              'rebuilds it. MySQL allows 8192 partitions, ' +
+                              'use --purge-data with hourly. Every ' +
+                              'pokemon write also deletes the rows of a ' +
+                              'spawn whose disappear time changed, since ' +
+                              'it is part of the primary key.'),
+                        choices=['hourly', 'daily'], default=None)
+    parser.add_argument('--partitions-ahead',
+                        help=('Hours ahead of time the pokemon partitions ' +
+                              'are created for.'),
+                        type=int, default=24)
     parser.add_argument('-pi', '--pokemon-inserts',
                         help='Number of pokemon to commit ' +
                         ' to the DB at once. Bulk inserts are faster than ' +
                         'singles.', default=1, type=int)
+    parser.add_argument('--fingerprint-cache-size',
+                        help=('Number of gyms, gym rosters, pokestops ' +
+                              'and weather cells (each) to remember, so ' +
+                              'unchanged ones are not written again ' +
+                              '(0 to disable).'),
+                        type=int, default=50000)
+    parser.add_argument('--fingerprint-refresh',
+                        help=('Seconds after which an unchanged gym, ' +
+                              'pokestop or weather cell is written anyway, ' +
+                              'to keep its scan time current.'),
+                        type=int, default=300)
+    parser.add_argument('--roster-refresh',
+                        help=('Seconds after which a gym\'s defenders and ' +
+                              'trainers are written in full, even if ' +
+                              'nothing changed.'),
+                        type=int, default=600)
+    parser.add_argument('--no-encounter-cache',
+                        help=('Store and forward every copy of a Pokemon, ' +
+                              'even when another scanner already sent the ' +
+                              'exact same encounter.'),
+                        action='store_true', default=False)
+    parser.add_argument('--batch-size',
+                        help=('Number of pokestops, gyms, raids, etc. to ' +
+                              'commit to the DB at once.'),
+                        type=int, default=50)
+    parser.add_argument('--batch-max-age',
+                        help=('Longest time (in seconds) a row waits for ' +
+                              'its batch to fill before it is committed ' +
+                              'anyway.'),
+                        type=float, default=2.0)
+    parser.add_argument('--shutdown-timeout',
+                        help=('Seconds to wait on shutdown for pending ' +
+                              'batches to reach the database.'),
+                        type=int, default=10)
+    parser.add_argument('--spool-dir',
+                        help=('Directory to spool database writes to ' +
+                              'while the database is unavailable (and ' +
+                              'on shutdown), they are replayed once it ' +
+                              'is back. Each ingest worker uses its own ' +
+                              'subdirectory.'),
+                        default=None)
+    parser.add_argument('--spool-segment-size',
+                        help=('Size in MB at which a new spool file is ' +
+                              'started.'),
+                        type=int, default=64)
+    parser.add_argument('--spool-fsync',
+                        help=('When to fsync the spool: every write, at ' +
+                              'most once a second, or never.'),
+                        choices=['always', 'interval', 'never'],
+                        default='interval')
+    parser.add_argument('--spool-mmap',
+                        help='Read the spool back with mmap.',
+                        action='store_true', default=False)
     parser.add_argument('--process-threads',
                         help=('Number of main workers threads; ' +
                               'increase if the queue falls behind.'),
                         type=int, default=3)
+    parser.add_argument('--process-queue-high',
+                        help=('Stop accepting webhooks once this many ' +
+                              'payloads are waiting to be processed ' +
+                              '(0 to disable).'),
+                        type=int, default=5000)
+    parser.add_argument('--process-queue-low',
+                        help=('Accept webhooks again once the process ' +
+                              'queue drains to this size. ' +
+                              'default = 80%% of the high watermark.'),
+                        type=int, default=0)
+    parser.add_argument('--db-queue-high',
+                        help=('Stop accepting webhooks once this many ' +
+                              'batches are waiting for the database ' +
+                              '(0 to disable).'),
+                        type=int, default=0)
+    parser.add_argument('--db-queue-low',
+                        help=('Accept webhooks again once the db queue ' +
+                              'drains to this size. ' +
+                              'default = 80%% of the high watermark.'),
+                        type=int, default=0)
+    parser.add_argument('--busy-status',
+                        help=('HTTP status returned to senders while the ' +
+                              'queues are over their watermark. RocketMap ' +
+                              'only retries on 503.'),
+                        type=int, choices=[429, 503], default=503)
+    parser.add_argument('--retry-after',
+                        help=('Seconds senders are asked to wait (via ' +
+                              'Retry-After) while the queues are over ' +
+                              'their watermark.'),
+                        type=int, default=5)
+    parser.add_argument('--ingest-workers',
+                        help=('Number of worker processes, each running ' +
+                              'its own HTTP/process/db pipeline on the ' +
+                              'same port. 0 runs everything in this ' +
+                              'process.'),
+                        type=int, default=0)
     parser.add_argument('-r', '--revoke', help='Revoke an authorization ' +
                         'token. An identifying string is required.')
     parser.add_argument('-wh', '--webhook',
@@ -152,12 +393,59 @@ def get_args():
 
     args = parser.parse_args()
 
-    if None in (args.db_name, args.db_user,
-                args.db_pass, args.db_host):
+    # Internal, passed by the supervisor to its ingest workers in their
+    # environment rather than as options, so they stay out of --help.
+    for name in ('worker_id', 'worker_listen_fd', 'worker_stats_fd'):
+        value = os.environ.get('WHSERVER_' + name.upper())
+        setattr(args, name, int(value) if value else None)
+
+    if args.keepalive_timeout is None:
+        args.keepalive_timeout = 15 if args.async_httpd else 0
+
+    if args.db_type == 'mysql' and None in (args.db_name, args.db_user,
+                                            args.db_pass, args.db_host):
         parser.print_usage()
         print(sys.argv[0] + ": DB info is not set correctly.")
         exit(1)
 
+    if args.db_type == 'sqlite':
+        # The upserts need INSERT ... ON CONFLICT DO UPDATE.
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            parser.print_usage()
+            print(sys.argv[0] + ": --db-type sqlite needs SQLite 3.24 or " +
+                  "newer, this Python has " + sqlite3.sqlite_version + ".")
+            exit(1)
+        if args.pokemon_partitions:
+            parser.print_usage()
+            print(sys.argv[0] + ": --pokemon-partitions needs MySQL.")
+            exit(1)
+        # SQLite has one writer at a time anyway.
+        args.db_threads = 1
+
+    shard_names = set()
+    for shard in args.db_shard:
+        match = re.match(r'^(\w+):(box=(-?[\d.]+,){3}-?[\d.]+|' +
+                         r's2=[0-9a-fA-F]+(,[0-9a-fA-F]+)*):(\w+)://.+$',
+                         shard.strip())
+        if not match or match.group(1) in shard_names:
+            parser.print_usage()
+            print(sys.argv[0] + ": --db-shard wants a unique name:area:url, " +
+                  "not " + repr(shard) + ".")
+            exit(1)
+        if match.group(5) != args.db_type:
+            parser.print_usage()
+            print(sys.argv[0] + ": --db-shard " + match.group(1) + " isn't " +
+                  "a " + args.db_type + " database, like the main one.")
+            exit(1)
+        shard_names.add(match.group(1))
+
+    for setting in args.db_session:
+        if not re.match(r'^\s*\w+\s*=\s*[\w.\-\']+\s*$', setting):
+            parser.print_usage()
+            print(sys.argv[0] + ": --db-session wants name=value, not " +
+                  repr(setting) + ".")
+            exit(1)
+
     return args
 
 
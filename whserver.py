@@ -3,8 +3,9 @@ import logging
 from threading import Thread
 import threading
 
-from models import db, db_updater, create_tables, drop_tables, \
-    clean_db_loop, Authorizations, bulk_upsert
+from models import db, db_updater, spool_replayer, create_tables, \
+    drop_tables, clean_db_loop, Authorizations, bulk_upsert, \
+    use_plain_database
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 from SocketServer import ThreadingMixIn
@@ -13,9 +14,19 @@ import random
 import string
 from sets import Set
 from webhook import wh_updater
-from process import main_process, Auth, process_stats
+from process import main_process, Auth, process_stats, forward_stats, \
+    WorkerStats
+import os
+import sys
+import signal
 import socket
+import subprocess
 import time
+from ingest import accept_payload, read_body, BodyError, IngestServer
+from batch import batch_flusher, drain_batches
+from expiry import expiry_loop, load_expiries
+from shard import shards, targets, for_each_shard
+from spool import get_spool
 from utils import get_args, get_queues
 
 logging.basicConfig(
@@ -66,11 +77,18 @@ class ThreadedServer(ThreadingMixIn, HTTPServer):
 
 
 class HTTPHandler(BaseHTTPRequestHandler):
+    # Senders post several frames per second, so let them reuse the
+    # connection instead of paying a new handshake each time.
+    if args.keepalive_timeout:
+        protocol_version = 'HTTP/1.1'
+        timeout = args.keepalive_timeout
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.requests_handled = 0
+
     # Override the default finish() because
     # http://bugs.python.org/issue14574
-    post_fails = 0
-    post_success = 0
-
     def finish(self, *args, **kw):
         try:
             if not self.wfile.closed:
@@ -90,34 +108,35 @@ class HTTPHandler(BaseHTTPRequestHandler):
         log.debug("%s", format % args)
 
     def do_POST(self):
-        # First check if the path is an accepted value
-        # TODO: Implement this
-        if self.auth.validate(self.path) is False:
-            try:
-                self.send_response(404)
-                self.end_headers()
-            except:
-                pass
-            self.post_fails += 1
-            return
-        data_string = self.rfile.read(int(self.headers['Content-Length']))
-
         try:
-            self.send_response(200)
+            data_string, received = read_body(self.rfile, self.headers)
+        except BodyError as e:
+            log.info('Rejected request body: %s', e)
+            # We don't know how much of the body is left, so hang up.
+            status, headers = e.status, [('Connection', 'close')]
+        else:
+            status, headers = accept_payload(self.auth, self.path,
+                                             data_string, received)
+        self.requests_handled += 1
+        try:
+            self.send_response(status)
+            for header in headers:
+                self.send_header(*header)
+            self.send_header('Content-Length', '0')
+            if self.requests_handled >= args.keepalive_requests:
+                # This also makes BaseHTTPRequestHandler hang up.
+                self.send_header('Connection', 'close')
             self.end_headers()
         except:
             pass
-        self.post_success += 1
-        # Put it in the process queue
-        process_queue.put(data_string)
 
 
-def validate_args():
-    if args.clear_db:
-        drop_tables(db)
-        create_tables(db)
-        log.info("Drop and create complete.")
-        exit(0)
+def admin_commands():
+    # These only touch the authorizations table, they don't need the
+    # pool or the schema check.
+    if not (args.list or args.generate or args.revoke):
+        return
+    use_plain_database()
 
     if args.list:
         print "--- Authorization keys: ---"
@@ -128,6 +147,8 @@ def validate_args():
                    token.name)
         exit(0)
     if args.generate:
+        # The first token can come before the server ever ran.
+        Authorizations.create_table(fail_silently=True)
         query = Authorizations.select(Authorizations.token).where(
             Authorizations.name ==
             args.generate)
@@ -154,6 +175,17 @@ def validate_args():
         else:
             print "No token found."
         exit(0)
+
+
+def validate_args():
+    if args.clear_db:
+        drop_tables(db)
+        create_tables(db)
+        for_each_shard(drop_tables)
+        for_each_shard(create_tables)
+        log.info("Drop and create complete.")
+        exit(0)
+
     if args.no_gyms:
         args.no_gymdetail = True
 
@@ -173,11 +205,19 @@ def launch_httpd(httpd, auth):
     log.info("Server Stops - %s:%s", args.host, args.port)
 
 
-def launch_threaded_httpd(handler, auth):
+def bind_socket(reuse_port=False):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((args.host, args.port))
-    sock.listen(5)
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+def launch_threaded_httpd(handler, auth, sock=None):
+    if sock is None:
+        sock = bind_socket()
     log.info("Launching HTTP server - %s:%s", args.host, args.port)
     [ThreadHTTP(i, sock, handler, auth) for i in range(args.httpd_threads)]
     while (1):
@@ -185,6 +225,100 @@ def launch_threaded_httpd(handler, auth):
     log.info("Server Stops - %s:%s", args.host, args.port)
 
 
+def launch_async_httpd(auth, sock=None):
+    if sock is None:
+        sock = bind_socket()
+    sock.listen(ThreadedServer.request_queue_size)
+    log.info("Launching event-loop HTTP server - %s:%s", args.host,
+             args.port)
+    IngestServer(sock, auth).serve_forever()
+
+
+def reuse_port_supported():
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def spawn_ingest_worker(i, listen_fd, worker_stats):
+    # Workers are fresh interpreters running this same script, so they
+    # don't inherit any of our threads or database connections.
+    cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+    env = dict(os.environ, WHSERVER_WORKER_ID=str(i))
+    if listen_fd is not None:
+        env['WHSERVER_WORKER_LISTEN_FD'] = str(listen_fd)
+
+    if not args.runtime_statistics:
+        return subprocess.Popen(cmd, env=env)
+
+    read_fd, write_fd = os.pipe()
+    env['WHSERVER_WORKER_STATS_FD'] = str(write_fd)
+    proc = subprocess.Popen(cmd, env=env)
+    os.close(write_fd)
+    t = Thread(target=worker_stats.collect, args=(i, os.fdopen(read_fd)),
+               name='worker-stats-{}'.format(i))
+    t.daemon = True
+    t.start()
+    return proc
+
+
+def launch_ingest_workers():
+    # With SO_REUSEPORT every worker binds the port itself and the kernel
+    # spreads the connections. Otherwise they all accept on our socket.
+    listen_fd = None
+    if reuse_port_supported():
+        log.info("Launching %d ingest workers on %s:%s (SO_REUSEPORT).",
+                 args.ingest_workers, args.host, args.port)
+    else:
+        sock = bind_socket()
+        listen_fd = sock.fileno()
+        log.info("Launching %d ingest workers on %s:%s (shared socket).",
+                 args.ingest_workers, args.host, args.port)
+
+    worker_stats = WorkerStats()
+    workers = [spawn_ingest_worker(i, listen_fd, worker_stats)
+               for i in range(args.ingest_workers)]
+    try:
+        while True:
+            time.sleep(1)
+            for i, proc in enumerate(workers):
+                if proc.poll() is not None:
+                    log.warning("Ingest worker %d exited (%d), restarting.",
+                                i, proc.returncode)
+                    workers[i] = spawn_ingest_worker(i, listen_fd,
+                                                     worker_stats)
+    finally:
+        for proc in workers:
+            if proc.poll() is None:
+                proc.terminate()
+        # Give them the time to drain their batches.
+        for proc in workers:
+            proc.wait()
+
+
+def worker_socket():
+    if args.worker_listen_fd is not None:
+        return socket.fromfd(args.worker_listen_fd, socket.AF_INET,
+                             socket.SOCK_STREAM)
+    return bind_socket(reuse_port=True)
+
+
+def watch_supervisor(ppid):
+    # Don't outlive the supervisor, but still go through the normal
+    # shutdown so the batches are drained or spooled.
+    while os.getppid() == ppid:
+        time.sleep(5)
+    log.warning("Supervisor went away, exiting.")
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
 if __name__ == '__main__':
 
     # Add file logging if enabled.
@@ -200,12 +334,68 @@ if __name__ == '__main__':
     else:
         log.setLevel(logging.INFO)
 
-    if not args.clear_db:
+    admin_commands()
+
+    # Let a plain kill (and the supervisor stopping its workers) go
+    # through the same shutdown as Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    worker = args.worker_id is not None
+    if worker:
+        threading.current_thread().name = 'worker-{}'.format(args.worker_id)
+        t = Thread(target=watch_supervisor, args=(os.getppid(),),
+                   name='watch-supervisor')
+        t.daemon = True
+        t.start()
+    elif not args.clear_db:
+        # The supervisor already took care of the schema for its workers.
         create_tables(db)
+        for_each_shard(create_tables)
     # If we're doing certain things, we'll do them and Then
     # quit
     validate_args()
 
+    # start the db-cleaner, only once for all the ingest workers.
+    if not worker:
+        t = Thread(target=clean_db_loop,
+                   args=([database for database, queue in targets()],),
+                   name='db-cleaner')
+        t.daemon = True
+        t.start()
+
+        # The workers only know about what they receive themselves.
+        load_expiries()
+
+    t = Thread(target=expiry_loop, name='expiry')
+    t.daemon = True
+    t.start()
+
+    if worker and args.worker_stats_fd is not None:
+        log.debug("Starting thread to forward statistics.")
+        t = Thread(target=forward_stats,
+                   args=(os.fdopen(args.worker_stats_fd, 'w'),),
+                   name='fwd-stats')
+        t.daemon = True
+        t.start()
+    elif args.runtime_statistics:
+        log.debug("Starting thread for statistics.")
+        t = Thread(target=process_stats, name='proc-stats')
+        t.daemon = True
+        t.start()
+
+    if args.ingest_workers and not worker:
+        launch_ingest_workers()
+        exit(0)
+
+    # Hand the connection we started with back, and have one ready for
+    # each thread that keeps its own.
+    db.release()
+    db.prewarm(args.db_threads + (1 if get_spool() is not None else 0))
+    for shard in shards:
+        shard.db.release()
+        shard.db.prewarm(args.db_threads +
+                         (1 if get_spool(shard.name) is not None else 0))
+
     # Thread(s) to process database updates.
     # I won't take credit for this. This is straight from RocketMap
     # But if we're getting thrashed with multiple webhook senders
@@ -216,17 +406,25 @@ if __name__ == '__main__':
         t.daemon = True
         t.start()
 
-    # start the db-cleaner
-    t = Thread(target=clean_db_loop, name='db-cleaner')
-    t.daemon = True
-    t.start()
-
-    if args.runtime_statistics:
-        log.debug("Starting thread for statistics.")
-        t = Thread(target=process_stats, name='proc-stats')
+    # Replays what the database missed while it was away.
+    if get_spool() is not None:
+        t = Thread(target=spool_replayer, name='spool-replayer')
         t.daemon = True
         t.start()
 
+    # Every --db-shard gets as many db threads, and a replayer of its own.
+    for shard in shards:
+        for i in range(args.db_threads):
+            t = Thread(target=db_updater, args=(shard,),
+                       name='db-{}-{}'.format(shard.name, i))
+            t.daemon = True
+            t.start()
+        if get_spool(shard.name) is not None:
+            t = Thread(target=spool_replayer, args=(shard,),
+                       name='spool-{}'.format(shard.name))
+            t.daemon = True
+            t.start()
+
     # starting web hook server threads
     for i in range(args.wh_threads):
         log.debug('Starting wh-updater worker thread %d', i)
@@ -240,12 +438,34 @@ if __name__ == '__main__':
         t.daemon = True
         t.start()
 
+    # Commits batches that don't fill up in time.
+    t = Thread(target=batch_flusher, name='batch-flusher')
+    t.daemon = True
+    t.start()
+
     # Start authorization thread
     auth = Auth()
 
     # Start HTTP server
-    if args.safe_httpd:
-        httpd = ThreadedServer((args.host, args.port), HTTPHandler)
-        launch_httpd(httpd, auth)
-    else:
-        launch_threaded_httpd(HTTPHandler, auth)
+    sock = worker_socket() if worker else None
+    try:
+        if args.async_httpd:
+            launch_async_httpd(auth, sock)
+        elif args.safe_httpd:
+            httpd = ThreadedServer((args.host, args.port), HTTPHandler,
+                                   sock is None)
+            if sock is not None:
+                httpd.socket = sock
+                httpd.server_activate()
+            launch_httpd(httpd, auth)
+        else:
+            launch_threaded_httpd(HTTPHandler, auth, sock)
+    finally:
+        # Don't lose what's still waiting in the batches.
+        log.info("Shutting down, flushing pending batches.")
+        drain_batches(args.shutdown_timeout)
+        if worker:
+            # Nothing is left once drained. Tearing the interpreter down
+            # under a worker's daemon threads can hang after its
+            # supervisor died, and the supervisor may be waiting on us.
+            os._exit(0)